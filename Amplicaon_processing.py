@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
 import os
+import shlex
 import sys
 import shutil
 import subprocess
-import pandas as pd
 import logging
 import argparse
+import functools
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+try:
+    # 导入后 input() 支持行编辑和历史记录（Windows 上可能不可用）
+    import readline  # noqa: F401
+except ImportError:
+    pass
 
 # 设置日志记录
 logging.basicConfig(
@@ -14,6 +30,24 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# 保存用户手动输入的工具路径，之后运行时无需再次输入
+TOOL_CONFIG = os.path.expanduser("~/.config/amplicon/tools.json")
+
+# 元数据文件的一行（无表头 TSV 的列顺序）
+Row = namedtuple('Row', 'run_id sample_id forward_primer reverse_primer forward_file reverse_file')
+
+def load_metadata(metadata_file):
+    """
+    读取元数据文件（TSV 格式，无表头）。
+    
+    参数:
+        metadata_file (str): 元数据文件路径
+    返回:
+        list: Row 列表，每个样本一行
+    """
+    with open(metadata_file) as f:
+        return [Row(*line.rstrip('\n').split('\t')) for line in f if line.strip()]
+
 def get_valid_input(prompt, validator=None, error_msg="输入不符合要求，请重新输入。"):
     """
     循环提示用户输入，直到满足 validator 条件或用户输入“exist”退出程序。
@@ -26,7 +60,10 @@ def get_valid_input(prompt, validator=None, error_msg="输入不符合要求，
         str: 有效的输入
     """
     while True:
-        value = input(prompt).strip()
+        try:
+            value = input(prompt).strip()
+        except EOFError:
+            sys.exit(f"无法读取输入（{prompt.strip().rstrip(':：')}），非交互运行时请通过命令行参数指定（见 --help）。")
         if value.lower() == "exist":
             sys.exit("用户选择结束运行。")
         if validator is None or validator(value):
@@ -34,52 +71,819 @@ def get_valid_input(prompt, validator=None, error_msg="输入不符合要求，
         else:
             print(error_msg)
 
+@functools.cache
+def load_tool_config():
+    """
+    读取 TOOL_CONFIG 中保存的工具路径，文件不存在或无法解析时返回空字典。
+    
+    返回:
+        dict: 工具名称到完整路径的映射
+    """
+    try:
+        with open(TOOL_CONFIG) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("无法读取工具路径配置 %s: %s", TOOL_CONFIG, e)
+        return {}
+    return config if isinstance(config, dict) else {}
+
+def save_tool_path(tool_name, tool_path):
+    """
+    将用户输入的工具路径写入 TOOL_CONFIG，写入失败时只记录警告。
+    """
+    # 直接更新缓存中的字典，同一次运行中多次保存不会互相覆盖
+    config = load_tool_config()
+    config[tool_name] = tool_path
+    try:
+        os.makedirs(os.path.dirname(TOOL_CONFIG), exist_ok=True)
+        temp_config = TOOL_CONFIG + ".tmp"
+        with open(temp_config, 'w') as f:
+            json.dump(config, f, indent=2)
+        os.replace(temp_config, TOOL_CONFIG)
+    except OSError as e:
+        logging.warning("无法保存工具路径到 %s: %s", TOOL_CONFIG, e)
+        return
+    logging.info("%s 的路径已保存到 %s", tool_name, TOOL_CONFIG)
+
+@functools.cache
+def find_tool(tool_name):
+    """
+    查找工具路径，不进行交互。
+    优先使用环境变量 AMPLICON_<工具名大写>（例如 AMPLICON_VSEARCH）指定的路径，
+    其次是 TOOL_CONFIG 中保存的路径，最后在系统路径中查找。
+    
+    参数:
+        tool_name (str): 工具名称
+    返回:
+        str: 工具的完整路径，未找到时返回 None
+    """
+    env_name = f"AMPLICON_{tool_name.upper()}"
+    env_path = os.environ.get(env_name)
+    if env_path:
+        if os.path.isfile(env_path) and os.access(env_path, os.X_OK):
+            return env_path
+        logging.warning("环境变量 %s 指定的 %s 不存在或不可执行，改为在系统路径中查找。", env_name, env_path)
+    saved_path = load_tool_config().get(tool_name)
+    if saved_path:
+        if os.path.isfile(saved_path) and os.access(saved_path, os.X_OK):
+            return saved_path
+        logging.warning("%s 中保存的 %s 不存在或不可执行，改为在系统路径中查找。", TOOL_CONFIG, saved_path)
+    return shutil.which(tool_name)
+
+@functools.cache
 def check_tool(tool_name):
     """
-    检查指定工具是否在系统路径中可用。
-    如果不可用，提示用户输入安装路径。
+    检查指定工具是否可用（见 find_tool）。
+    如果不可用，提示用户输入安装路径，并保存到 TOOL_CONFIG 供之后的运行使用。
+    结果会被缓存，同一工具只检查一次。
     
     参数:
         tool_name (str): 工具名称
     返回:
         str: 工具的完整路径
     """
-    tool_path = shutil.which(tool_name)
+    tool_path = find_tool(tool_name)
     if tool_path:
-        logging.info(f"{tool_name} found at {tool_path}")
+        logging.info("%s found at %s", tool_name, tool_path)
         return tool_path
     else:
         while True:
-            dir_input = input(f"{tool_name} not found. Please input its installation directory (absolute path): ")
+            try:
+                dir_input = input(f"{tool_name} not found. Please input its installation directory (absolute path): ")
+            except EOFError:
+                sys.exit(f"未找到 {tool_name}，且无法读取输入。非交互运行时请将其加入系统路径，"
+                         f"或用环境变量 AMPLICON_{tool_name.upper()} 指定可执行文件的完整路径。")
             if dir_input.strip().lower() == "exist":
                 sys.exit("用户选择结束运行。")
             dir_path = os.path.abspath(dir_input.strip("'"))
             tool_full_path = os.path.join(dir_path, tool_name)
             if os.path.isfile(tool_full_path) and os.access(tool_full_path, os.X_OK):
-                logging.info(f"{tool_name} found at {tool_full_path}")
+                logging.info("%s found at %s", tool_name, tool_full_path)
+                save_tool_path(tool_name, tool_full_path)
                 return tool_full_path
             else:
                 print("Tool not found or not executable. Please try again.")
 
-def run_command(cmd, description=""):
+def scan_dir(directory):
+    """
+    用一次 os.scandir 列出目录中的所有文件名。
+    之后可用集合成员判断代替对每个文件调用 os.path.exists，减少网络文件系统上的 stat 调用。
+    
+    参数:
+        directory (str): 目录路径
+    返回:
+        set: 目录中的文件名集合
+    """
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries}
+
+def file_in(directory, name, available):
+    """
+    判断 directory 下的文件 name 是否存在。
+    name 不含子目录时直接查 scan_dir 得到的 available 集合，否则回退到 os.path.exists。
+    """
+    if os.path.dirname(name):
+        return os.path.exists(os.path.join(directory, name))
+    return name in available
+
+def params_file(outputs):
+    """
+    返回记录某一步骤参数的文件路径（第一个输出文件加 .params 后缀）。
+    """
+    return f"{outputs[0]}.params"
+
+def write_params(outputs, params):
+    """
+    步骤成功后将其生效的参数以 JSON 写入 params_file(outputs)，续跑时据此判断参数是否改变。
+    
+    参数:
+        outputs (list): 该步骤的输出文件路径列表
+        params (dict): 该步骤的参数
+    """
+    stamp = params_file(outputs)
+    with open(stamp + ".tmp", 'w') as f:
+        json.dump(params, f, sort_keys=True)
+    os.replace(stamp + ".tmp", stamp)
+
+def up_to_date(outputs, inputs, params=None):
+    """
+    判断输出文件是否都已存在且不早于任何输入文件（与 make 相同的时间戳规则）。
+    给出 params 时，参数文件也视为输出之一，且其中记录的参数必须与 params 相同，
+    否则即使时间戳较新也认为需要重新执行。
+    
+    参数:
+        outputs (list): 输出文件路径列表
+        inputs (list): 输入文件路径列表
+        params (dict): 该步骤的参数
+    返回:
+        bool: 输出均为最新时返回 True
+    """
+    if params is not None:
+        stamp = params_file(outputs)
+        try:
+            with open(stamp) as f:
+                if json.load(f) != json.loads(json.dumps(params)):
+                    return False
+        except (OSError, ValueError):
+            return False
+        outputs = list(outputs) + [stamp]
+    if not all(os.path.exists(o) for o in outputs):
+        return False
+    newest_input = max((os.path.getmtime(i) for i in inputs), default=0)
+    return all(os.path.getmtime(o) >= newest_input for o in outputs)
+
+def remove_outputs(outputs):
+    """
+    删除执行失败时残留的输出文件，避免续跑时被误判为已完成。
+    """
+    for output in outputs:
+        if os.path.exists(output):
+            os.remove(output)
+
+def tail_log(log_file, lines=40):
+    """
+    读取日志文件末尾的若干行，用于在命令失败时记录工具的错误信息。
+    
+    参数:
+        log_file (str): 日志文件路径
+        lines (int): 读取的行数
+    返回:
+        str: 日志末尾的内容
+    """
+    with open(log_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 64 * 1024))
+        data = f.read()
+    return b"\n".join(data.splitlines()[-lines:]).decode(errors="replace")
+
+def run_command(cmd, description, log_file, inputs=None, outputs=(), force=False, params=None):
     """
     执行外部命令并检查是否成功。
+    工具的 stdout/stderr 直接写入日志文件，不在内存中缓存；失败时将日志末尾记录到主日志。
     
     参数:
         cmd (list): 命令及其参数列表
         description (str): 命令的描述，用于日志记录
+        log_file (str): 工具输出的日志文件路径
+        inputs (list): 命令的输入文件；与 outputs 同时给出时，若输出均为最新则跳过执行
+        outputs (list): 命令的输出文件；执行失败时会被删除
+        force (bool): 为 True 时忽略时间戳检查，总是重新执行
+        params (dict): 影响输出的参数；与上次成功执行时记录的不同时重新执行（见 up_to_date）
     """
-    logging.info(f"Running: {description}")
-    # 将 cmd 列表中的所有元素转换为字符串再拼接
-    logging.info(f"Command: {' '.join(map(str, cmd))}")
+    if inputs is not None and outputs and not force and up_to_date(outputs, inputs, params):
+        logging.info("跳过 %s - 输出文件已是最新。", description)
+        return
+    if params is not None and outputs:
+        # 先删除旧的参数文件，执行失败或中断时不会留下与输出不符的记录
+        remove_outputs([params_file(outputs)])
+    logging.info("Running: %s", description)
+    # 仅在会输出 INFO 日志时拼接命令行；shlex.join 对含空格等字符的参数加引号，日志中的命令可直接复制重跑
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("Command: %s", shlex.join(map(str, cmd)))
     try:
-        result = subprocess.run(cmd, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-        logging.info(f"{description} completed successfully.")
-        logging.debug(f"Output: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error in {description}: {e.stderr}")
+        with open(log_file, 'w') as log:
+            subprocess.run(cmd, check=True, stdout=log, stderr=subprocess.STDOUT)
+        if params is not None and outputs:
+            write_params(outputs, params)
+        logging.info("%s completed successfully.", description)
+    except subprocess.CalledProcessError:
+        logging.error("Error in %s（详见 %s）:\n%s", description, log_file, tail_log(log_file))
+        remove_outputs(outputs)
+        raise
+    except BaseException:
+        remove_outputs(outputs)
         raise
 
+def wait_processes(procs, description="", log_file=None, outputs=()):
+    """
+    等待一组通过管道连接的进程全部结束，并检查是否都执行成功。
+    任一进程失败时终止其余进程，避免它们阻塞在打开或读写管道上。
+    
+    参数:
+        procs (list): (cmd, Popen) 元组列表
+        description (str): 命令的描述，用于日志记录
+        log_file (str): 这组进程输出的日志文件路径
+        outputs (list): 这组进程的输出文件；执行失败时会被删除
+    """
+    error = None
+    pending = list(procs)
+    try:
+        while pending:
+            for item in list(pending):
+                cmd, proc = item
+                if proc.poll() is None:
+                    continue
+                pending.remove(item)
+                if proc.returncode != 0 and error is None:
+                    error = subprocess.CalledProcessError(proc.returncode, cmd)
+                    for _, other in pending:
+                        other.kill()
+            if pending:
+                time.sleep(0.1)
+    except BaseException:
+        for _, proc in pending:
+            proc.kill()
+        remove_outputs(outputs)
+        raise
+    if error is not None:
+        logging.error("Error in %s（详见 %s）:\n%s", description, log_file, tail_log(log_file))
+        remove_outputs(outputs)
+        raise error
+    logging.info("%s completed successfully.", description)
+
+def start_gzip(tools, stdin, output_file, threads, log):
+    """
+    启动 pigz，将 stdin 中的数据以压缩级别 1 多线程压缩后写入 output_file。
+    
+    参数:
+        tools (dict): 工具路径字典（需包含 pigz）
+        stdin: 待压缩数据的输入管道
+        output_file (str): 压缩输出文件路径
+        threads (int): pigz 使用的线程数
+        log: pigz 错误信息写入的日志文件对象
+    返回:
+        tuple: (cmd, Popen)
+    """
+    cmd = [tools["pigz"], "-1", "-p", str(threads), "-c"]
+    with open(output_file, 'wb') as out:
+        proc = subprocess.Popen(cmd, stdin=stdin, stdout=out, stderr=log)
+    return cmd, proc
+
+def demux_one(row, tools, input_dir, demux_dir, threads_per_job, log_dir, force=False):
+    """
+    使用 cutadapt 对单个样本进行解复用（双端模式），调用方需事先确认原始文件存在。
+    
+    参数:
+        row (Row): 元数据中的一行
+        tools (dict): 工具路径字典
+        input_dir (str): 原始测序文件目录
+        demux_dir (str): 解复用输出目录
+        threads_per_job (int): 单个任务使用的线程数
+        log_dir (str): 每个样本的工具日志目录
+        force (bool): 为 True 时即使输出已是最新也重新执行
+    返回:
+        tuple: (sample_id, ok)
+    """
+    sample_id = row.sample_id
+    barcode_for = row.forward_primer
+    barcode_rev = row.reverse_primer
+    forward_file = os.path.join(input_dir, row.forward_file)
+    reverse_file = os.path.join(input_dir, row.reverse_file)
+    output_forward = os.path.join(demux_dir, f"{sample_id}.R1.fastq.gz")
+    output_reverse = os.path.join(demux_dir, f"{sample_id}.R2.fastq.gz")
+    
+    cmd = [
+        tools["cutadapt"],
+        "-g", f"^{barcode_for}",
+        "-G", f"^{barcode_rev}",
+        "-o", output_forward,
+        "-p", output_reverse,
+        "-Z",
+        "-j", str(threads_per_job),
+        "--discard-untrimmed",
+        "-e", "0.1",
+        forward_file, reverse_file
+    ]
+    run_command(cmd, f"样本解复用 {sample_id}", os.path.join(log_dir, f"1-demultiplex.{sample_id}.log"),
+                inputs=[forward_file, reverse_file], outputs=[output_forward, output_reverse], force=force)
+    return sample_id, True
+
+def demux_group(rows, tools, input_dir, demux_dir, threads_per_job, log_dir, force=False):
+    """
+    使用 cutadapt 一次性解复用共享同一对原始测序文件的多个样本（双端模式）。
+    各样本的正、反向引物写入锚定的 barcode FASTA 并按顺序配对（--pair-adapters），
+    原始数据只需读取一遍，按 {name} 模板输出每个样本的文件。
+    
+    参数:
+        rows (list): 共享同一对原始文件的元数据行，各样本的正向引物、反向引物均不重复
+        其余参数同 demux_one
+    返回:
+        tuple: (样本ID元组, ok)
+    """
+    sample_ids = tuple(row.sample_id for row in rows)
+    forward_file = os.path.join(input_dir, rows[0].forward_file)
+    reverse_file = os.path.join(input_dir, rows[0].reverse_file)
+    outputs = [os.path.join(demux_dir, f"{sample_id}.{read}.fastq.gz")
+               for sample_id in sample_ids for read in ("R1", "R2")]
+    log_name = f"{os.path.basename(forward_file)}_{os.path.basename(reverse_file)}"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        forward_barcodes = os.path.join(tmp_dir, "forward_barcodes.fasta")
+        reverse_barcodes = os.path.join(tmp_dir, "reverse_barcodes.fasta")
+        with open(forward_barcodes, 'w') as fwd_f, open(reverse_barcodes, 'w') as rev_f:
+            for row in rows:
+                fwd_f.write(f">{row.sample_id}\n^{row.forward_primer}\n")
+                rev_f.write(f">{row.sample_id}\n^{row.reverse_primer}\n")
+        cmd = [
+            tools["cutadapt"],
+            "-g", f"file:{forward_barcodes}",
+            "-G", f"file:{reverse_barcodes}",
+            "--pair-adapters",
+            "-o", os.path.join(demux_dir, "{name}.R1.fastq.gz"),
+            "-p", os.path.join(demux_dir, "{name}.R2.fastq.gz"),
+            "-Z",
+            "-j", str(threads_per_job),
+            "--discard-untrimmed",
+            "-e", "0.1",
+            forward_file, reverse_file
+        ]
+        run_command(cmd, f"样本解复用 {log_name}（{len(rows)} 个样本）",
+                    os.path.join(log_dir, f"1-demultiplex.{log_name}.log"),
+                    inputs=[forward_file, reverse_file], outputs=outputs, force=force)
+    return sample_ids, True
+
+def split_stem(path):
+    """
+    按 seqkit split2 的规则取文件名主干：先去掉压缩扩展名，再去掉一层扩展名。
+    
+    参数:
+        path (str): 原始文件路径
+    返回:
+        str: 文件名主干（如 run.R2.fq.gz 的主干为 run.R2）
+    """
+    stem = os.path.basename(path)
+    for ext in (".gz", ".xz", ".zst", ".bz2"):
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+            break
+    return os.path.splitext(stem)[0]
+
+def split_pair(tools, forward_file, reverse_file, parts, chunk_dir, threads, log_dir, force=False):
+    """
+    使用 seqkit split2 将一对原始测序文件按相同的 reads 顺序拆分为 parts 份，
+    拆分结果可以分别解复用后再按样本合并。
+    
+    参数:
+        tools (dict): 工具路径字典
+        forward_file (str): 正向原始文件路径
+        reverse_file (str): 反向原始文件路径
+        parts (int): 拆分的份数
+        chunk_dir (str): 拆分结果目录（每对原始文件单独一个目录，目录名同时用作日志名）
+        threads (int): seqkit 使用的线程数
+        log_dir (str): 日志目录
+        force (bool): 为 True 时总是重新拆分
+    返回:
+        list: 按顺序排列的 (正向分块, 反向分块) 路径元组
+    """
+    # 拆分成功后写入标记文件，续跑时据此跳过拆分
+    done_marker = os.path.join(chunk_dir, ".split_done")
+    if force or not up_to_date([done_marker], [forward_file, reverse_file]):
+        if os.path.isdir(chunk_dir):
+            shutil.rmtree(chunk_dir)
+        os.makedirs(chunk_dir)
+        cmd = [
+            tools["seqkit"], "split2",
+            "-1", forward_file,
+            "-2", reverse_file,
+            "-p", str(parts),
+            "-O", chunk_dir,
+            "-j", str(threads)
+        ]
+        run_command(cmd, f"拆分 {os.path.basename(forward_file)} 为 {parts} 份",
+                    os.path.join(log_dir, f"0-split.{os.path.basename(chunk_dir)}.log"))
+        open(done_marker, 'w').close()
+    # split2 的输出文件名为 <原文件名主干>.part_NNN.<扩展名>，按主干完全相同配对
+    names = sorted(name for name in scan_dir(chunk_dir) if ".part_" in name)
+    forward_stem = split_stem(forward_file)
+    reverse_stem = split_stem(reverse_file)
+    forward_parts = [name for name in names if name.rsplit(".part_", 1)[0] == forward_stem]
+    reverse_parts = [name for name in names if name.rsplit(".part_", 1)[0] == reverse_stem]
+    if not forward_parts or len(forward_parts) != len(reverse_parts):
+        raise RuntimeError(f"{chunk_dir} 中的正向和反向分块文件无法配对。")
+    return [(os.path.join(chunk_dir, f), os.path.join(chunk_dir, r))
+            for f, r in zip(forward_parts, reverse_parts)]
+
+def merge_chunk_outputs(sample_id, part_ids, demux_dir):
+    """
+    将各分块的解复用结果按顺序合并为该样本的解复用文件（多个 gzip 文件直接拼接仍是合法的 gzip 文件），
+    合并后删除分块结果。任一分块结果缺失时抛出异常，不生成不完整的合并文件。
+    
+    参数:
+        sample_id (str): 样本ID
+        part_ids (list): 该样本在各分块中的临时样本ID（按分块顺序）
+        demux_dir (str): 解复用目录
+    """
+    for read in ("R1", "R2"):
+        output_file = os.path.join(demux_dir, f"{sample_id}.{read}.fastq.gz")
+        part_files = [os.path.join(demux_dir, f"{part_id}.{read}.fastq.gz") for part_id in part_ids]
+        missing = [part_file for part_file in part_files if not os.path.exists(part_file)]
+        if missing:
+            raise FileNotFoundError(f"样本 {sample_id} 的分块解复用结果缺失: {', '.join(missing)}")
+        temp_file = output_file + ".tmp"
+        with open(temp_file, 'wb') as out:
+            for part_file in part_files:
+                append_file(part_file, out)
+        os.replace(temp_file, output_file)
+    for part_id in part_ids:
+        remove_outputs([os.path.join(demux_dir, f"{part_id}.{read}.fastq.gz") for read in ("R1", "R2")])
+
+def filter_fastq_lengths(src, dst, length_set):
+    """
+    从 src 逐条读取 FASTQ 记录（每条 4 行），仅将序列长度属于 length_set 的记录写入 dst。
+    
+    参数:
+        src: 以二进制模式打开的输入流
+        dst: 以二进制模式打开的输出流
+        length_set (frozenset): 允许的序列长度集合
+    """
+    while True:
+        header = src.readline()
+        if not header:
+            break
+        seq = src.readline()
+        plus = src.readline()
+        qual = src.readline()
+        if len(seq.rstrip(b"\r\n")) in length_set:
+            dst.write(header + seq + plus + qual)
+
+def pump_fastq_lengths(src, dst, length_set):
+    """
+    执行 filter_fastq_lengths，结束后关闭两端管道（供后台线程使用）。
+    """
+    try:
+        filter_fastq_lengths(src, dst, length_set)
+    except BrokenPipeError:
+        pass
+    finally:
+        src.close()
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+def merge_filter_derep_one(sample_id, tools, demux_dir, dereplicate_dir, threads_per_job, log_dir,
+                           min_length=None, max_length=None, lengths=None, gzip_output=False, force=False):
+    """
+    对单个样本依次进行双端合并、质量过滤和样本内去重复。
+    合并结果经命名管道（FIFO）传给质量过滤，过滤结果经标准输出管道传给去重复，
+    中间结果不写入磁盘，只保留去重复结果。
+    指定 lengths 时只保留长度属于这些值的序列，否则按 min_length~max_length 范围过滤。
+    gzip_output 为 True 时经 pigz 压缩输出 .derep.fasta.gz。
+    去重复结果已比解复用文件新时跳过该样本，force 为 True 时总是重新执行。
+    调用方需事先确认解复用文件存在。
+    
+    返回:
+        tuple: (sample_id, ok)
+    """
+    suffix = ".gz" if gzip_output else ""
+    demux_forward = os.path.join(demux_dir, f"{sample_id}.R1.fastq.gz")
+    demux_reverse = os.path.join(demux_dir, f"{sample_id}.R2.fastq.gz")
+    output_file = os.path.join(dereplicate_dir, f"{sample_id}.derep.fasta{suffix}")
+    log_file = os.path.join(log_dir, f"2-4-merge_filter_derep.{sample_id}.log")
+    # 长度参数改变时即使去重复结果较新也重新执行
+    if lengths is not None:
+        params = {"lengths": sorted(int(length) for length in lengths)}
+    else:
+        params = {"min_length": int(min_length), "max_length": int(max_length)}
+    if not force and up_to_date([output_file], [demux_forward, demux_reverse], params):
+        logging.info("跳过 %s - 去重复结果已是最新。", sample_id)
+        return sample_id, True
+    remove_outputs([params_file([output_file])])
+    if lengths is not None:
+        length_set = frozenset(int(length) for length in lengths)
+        min_length, max_length = str(min(length_set)), str(max(length_set))
+        # 长度值连续时等价于范围过滤，无需逐条筛选
+        if len(length_set) == max(length_set) - min(length_set) + 1:
+            lengths = None
+
+    description = f"合并、质量过滤并去重复样本 {sample_id}"
+    logging.info("Running: %s", description)
+    with tempfile.TemporaryDirectory(prefix=f"{sample_id}.") as tmp_dir, open(log_file, 'w') as log:
+        merged_fifo = os.path.join(tmp_dir, "merged.fastq")
+        os.mkfifo(merged_fifo)
+
+        merge_cmd = [
+            tools["vsearch"], "--fastq_mergepairs", demux_forward,
+            "--reverse", demux_reverse,
+            "--threads", str(threads_per_job),
+            "--fastqout", merged_fifo,
+            "--fastq_eeout"
+        ]
+        derep_cmd = [
+            tools["vsearch"], "--derep_fulllength", "-",
+            "--strand", "plus",
+            "--output", "-" if gzip_output else output_file,
+            "--sizeout",
+            "--relabel", f"{sample_id}.",
+            "--fasta_width", "0",
+            "--threads", str(threads_per_job)
+        ]
+        pump = None
+        if lengths is None:
+            filter_cmd = [
+                tools["vsearch"], "--fastx_filter", merged_fifo,
+                "--fastaout", "-",
+                "--fastq_maxee", "1.0",
+                "--fastq_maxee_rate", "0.01",
+                "--fastq_minlen", min_length,
+                "--fastq_maxlen", max_length,
+                "--fastq_maxns", "0",
+                "--fasta_width", "0",
+                "--threads", str(threads_per_job)
+            ]
+            merge = subprocess.Popen(merge_cmd, stdout=log, stderr=subprocess.STDOUT)
+            qfilter = subprocess.Popen(filter_cmd, stdout=subprocess.PIPE, stderr=log)
+            procs = [(merge_cmd, merge), (filter_cmd, qfilter)]
+        else:
+            # 先用 vsearch 按最小/最大长度粗筛并输出到管道，
+            # 由后台线程按长度集合逐条筛选后写入第二个 vsearch 进行质量过滤
+            prefilter_cmd = [
+                tools["vsearch"], "--fastx_filter", merged_fifo,
+                "--fastqout", "-",
+                "--fastq_minlen", min_length,
+                "--fastq_maxlen", max_length,
+                "--threads", str(threads_per_job)
+            ]
+            filter_cmd = [
+                tools["vsearch"], "--fastx_filter", "-",
+                "--fastaout", "-",
+                "--fastq_maxee", "1.0",
+                "--fastq_maxee_rate", "0.01",
+                "--fastq_maxns", "0",
+                "--fasta_width", "0",
+                "--threads", str(threads_per_job)
+            ]
+            merge = subprocess.Popen(merge_cmd, stdout=log, stderr=subprocess.STDOUT)
+            prefilter = subprocess.Popen(prefilter_cmd, stdout=subprocess.PIPE, stderr=log)
+            qfilter = subprocess.Popen(filter_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log)
+            pump = threading.Thread(target=pump_fastq_lengths,
+                                    args=(prefilter.stdout, qfilter.stdin, length_set), daemon=True)
+            pump.start()
+            procs = [(merge_cmd, merge), (prefilter_cmd, prefilter), (filter_cmd, qfilter)]
+        if gzip_output:
+            # vsearch 不能直接输出 gzip，去重复结果经管道交给 pigz 压缩
+            derep = subprocess.Popen(derep_cmd, stdin=qfilter.stdout, stdout=subprocess.PIPE, stderr=log)
+            procs.append((derep_cmd, derep))
+            procs.append(start_gzip(tools, derep.stdout, output_file, threads_per_job, log))
+            derep.stdout.close()
+        else:
+            derep = subprocess.Popen(derep_cmd, stdin=qfilter.stdout, stdout=log, stderr=subprocess.STDOUT)
+            procs.append((derep_cmd, derep))
+        # 管道读端已交给去重复进程，父进程关闭自己的副本，使过滤进程能感知下游退出
+        qfilter.stdout.close()
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Command: %s", " | ".join(shlex.join(map(str, cmd)) for cmd, _ in procs))
+        try:
+            wait_processes(procs, description, log_file, outputs=[output_file])
+        finally:
+            if pump is not None:
+                pump.join()
+    write_params([output_file], params)
+    return sample_id, True
+
+def append_file(src_path, dst):
+    """
+    将文件 src_path 的内容追加到以二进制模式打开的 dst。
+    支持 os.sendfile 时在内核中直接拷贝（不经过 Python 缓冲区），否则回退到 shutil.copyfileobj 分块拷贝。
+    
+    参数:
+        src_path (str): 源文件路径
+        dst: 以二进制写模式打开的目标文件对象
+    """
+    with open(src_path, 'rb') as src:
+        if hasattr(os, "sendfile"):
+            # sendfile 直接写入文件描述符，先清空 dst 的用户态缓冲区以保证顺序
+            dst.flush()
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            except OSError:
+                # 尚未写入任何数据时（例如文件系统不支持）回退到普通拷贝
+                if offset:
+                    raise
+        shutil.copyfileobj(src, dst, length=128 * 1024)
+
+def read_fasta(path):
+    """
+    逐条读取 FASTA 文件（支持 .gz），不把整个文件读入内存。
+
+    参数:
+        path (str): FASTA 文件路径
+    返回:
+        generator: (label, sequence) 元组
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt') as f:
+        label, chunks = None, []
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('>'):
+                if label is not None:
+                    yield label, ''.join(chunks)
+                label, chunks = line[1:], []
+            elif line:
+                chunks.append(line)
+        if label is not None:
+            yield label, ''.join(chunks)
+
+def build_otu_table(derep_file, uc_file, nochim_file, otu_table, sample_ids):
+    """
+    根据聚类的 --uc 结果生成 OTU 表，无需再次比对。
+    聚类输入为以序列 SHA1 为标签的全局去重复结果，uc 文件记录了每个标签所属的中心序列；
+    逐条读取带样本前缀的去重复文件，以序列 SHA1 查到所属中心序列后按样本累加丰度。
+    中心序列在嵌合体检测中被去除的聚类不写入 OTU 表，其中的 reads 不计入任何 OTU
+    （与 --usearch_global 以 97% 相似度比对到非嵌合 OTU 不同），各样本计入和去除的 reads 数写入日志。
+
+    参数:
+        derep_file (str): 合并后的各样本去重复文件（标签形如 SampleA.1;size=N）
+        uc_file (str): 聚类输出的 uc 文件
+        nochim_file (str): 去除嵌合体后的 OTU 序列
+        otu_table (str): 输出的 OTU 表路径（与 vsearch --otutabout 格式相同）
+        sample_ids (list): OTU 表中的样本列顺序
+    """
+    # uc 第 1 列为记录类型，第 9、10 列为查询序列和中心序列标签；S 记录的中心序列即其自身
+    centroid_of = {}
+    with open(uc_file) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'S':
+                query = fields[8].split(';')[0]
+                centroid_of[query] = query
+            elif fields[0] == 'H':
+                centroid_of[fields[8].split(';')[0]] = fields[9].split(';')[0]
+    otus = [label.split(';')[0] for label, _ in read_fasta(nochim_file)]
+    counts = {otu: {} for otu in otus}
+    assigned = dict.fromkeys(sample_ids, 0)
+    dropped = dict.fromkeys(sample_ids, 0)
+    unknown_samples = set()
+    for label, sequence in read_fasta(derep_file):
+        name, _, annotations = label.partition(';')
+        # 重命名后缀总是最后一个 "." 之后的序号，样本ID本身可以含 "."
+        sample_id = name.rpartition('.')[0]
+        if sample_id not in assigned:
+            if sample_id not in unknown_samples:
+                unknown_samples.add(sample_id)
+                logging.warning("去重复序列 %s 所属样本 %s 不在样本列表中，其丰度不计入 OTU 表", name, sample_id)
+            continue
+        size = 1
+        for annotation in annotations.split(';'):
+            if annotation.startswith("size="):
+                size = int(annotation[5:])
+        # 与 vsearch --relabel_sha1 一致：对转为大写、U 替换为 T 的序列计算 SHA1
+        digest = hashlib.sha1(sequence.upper().replace('U', 'T').encode()).hexdigest()
+        row = counts.get(centroid_of.get(digest))
+        if row is None:
+            dropped[sample_id] += size
+            continue
+        assigned[sample_id] += size
+        row[sample_id] = row.get(sample_id, 0) + size
+    for sample_id in sample_ids:
+        logging.info("样本 %s: %d 条 reads 计入 OTU 表，%d 条因所属聚类为嵌合体（或未聚类）被去除",
+                     sample_id, assigned[sample_id], dropped[sample_id])
+    total_dropped = sum(dropped.values())
+    if total_dropped:
+        logging.warning("共 %d 条 reads（占 %.2f%%）因所属聚类为嵌合体未计入 OTU 表；"
+                        "如需与以往结果（比对到非嵌合 OTU）保持一致，请使用 --otu_mapping usearch_global。",
+                        total_dropped, 100 * total_dropped / (total_dropped + sum(assigned.values())))
+    temp_table = otu_table + ".tmp"
+    with open(temp_table, 'w') as out:
+        out.write('\t'.join(["#OTU ID"] + sample_ids) + '\n')
+        for otu in otus:
+            out.write('\t'.join([otu] + [str(counts[otu].get(sample_id, 0)) for sample_id in sample_ids]) + '\n')
+    os.replace(temp_table, otu_table)
+
+def numa_cpu_slots(cpus_per_job):
+    """
+    将当前进程可用的 CPU 按 NUMA 节点分成若干组，每组 cpus_per_job 个，同一组不跨节点。
+    无法读取 NUMA 信息或单个节点的 CPU 少于 cpus_per_job 时，按编号顺序分组。
+    
+    参数:
+        cpus_per_job (int): 每组的 CPU 数
+    返回:
+        list: CPU 编号列表的列表
+    """
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    node_root = "/sys/devices/system/node"
+    try:
+        node_names = sorted((name for name in os.listdir(node_root)
+                             if name.startswith("node") and name[4:].isdigit()), key=lambda name: int(name[4:]))
+        for name in node_names:
+            with open(os.path.join(node_root, name, "cpulist")) as f:
+                cpus = []
+                for part in f.read().strip().split(','):
+                    if part:
+                        first, _, last = part.partition('-')
+                        cpus.extend(range(int(first), int(last or first) + 1))
+            cpus = [cpu for cpu in cpus if cpu in allowed]
+            if cpus:
+                nodes.append(cpus)
+    except (OSError, ValueError):
+        nodes = []
+    if not nodes:
+        nodes = [sorted(allowed)]
+    slots = [cpus[i:i + cpus_per_job]
+             for cpus in nodes for i in range(0, len(cpus) - cpus_per_job + 1, cpus_per_job)]
+    if not slots:
+        flat = [cpu for cpus in nodes for cpu in cpus]
+        slots = [flat[i:i + cpus_per_job] for i in range(0, len(flat), cpus_per_job)]
+    return slots
+
+def pin_worker(counter, cpus_per_job):
+    """
+    进程池的初始化函数：按启动顺序为每个工作进程分配一组 CPU（见 numa_cpu_slots）并绑定，
+    工作进程启动的外部工具继承该绑定，访问本节点内存。
+    """
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    slots = numa_cpu_slots(cpus_per_job)
+    cpus = slots[index % len(slots)]
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logging.warning("无法将工作进程绑定到 CPU %s: %s", cpus, e)
+
+def run_samples(worker, items, parallel_jobs, *args, pin_cpus=0, **kwargs):
+    """
+    使用进程池并行地对每个样本执行 worker，任一样本出错时抛出异常。
+    
+    参数:
+        worker (function): 单样本处理函数，返回 (sample_id, ok)
+        items (list): 每个样本的输入（元数据行或样本ID）
+        parallel_jobs (int): 同时运行的样本数
+        pin_cpus (int): 大于 0 时将每个工作进程绑定到 pin_cpus 个同一 NUMA 节点上的 CPU（仅 Linux）
+    返回:
+        set: worker 成功处理的样本ID（或样本ID元组）集合
+    """
+    done = set()
+    pool_kwargs = {}
+    if pin_cpus > 0 and parallel_jobs > 1:
+        pool_kwargs = {"initializer": pin_worker, "initargs": (multiprocessing.Value('i', 0), pin_cpus)}
+    with ProcessPoolExecutor(max_workers=parallel_jobs, **pool_kwargs) as executor:
+        futures = [executor.submit(worker, item, *args, **kwargs) for item in items]
+        for future in as_completed(futures):
+            sample_id, ok = future.result()
+            if ok:
+                done.add(sample_id)
+    return done
+
+def positive_int(value):
+    """
+    argparse 参数类型：正整数。
+    """
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} 不是正整数")
+    return number
+
+def positive_float(value):
+    """
+    argparse 参数类型：正数。
+    """
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} 不是正数")
+    return number
+
 def parse_args():
     """
     解析命令行参数。
@@ -123,7 +927,122 @@ def parse_args():
         required=True,
         help="使用的线程/核心数（整数，例如4）。"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--parallel_jobs",
+        type=positive_int,
+        default=1,
+        help="步骤1-4中同时处理的样本数，每个样本使用 threads // parallel_jobs 个线程（默认1，即逐个样本处理）。"
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=positive_float,
+        help="将大于该大小（GB）的原始测序文件拆分为多份并行解复用，再按样本合并（需要 seqkit）。"
+    )
+    parser.add_argument(
+        "--gzip_intermediates",
+        action="store_true",
+        help="以 gzip 压缩保存去重复的中间文件（.fasta.gz，需要 pigz）。解复用结果总是以 .fastq.gz 保存。"
+    )
+    parser.add_argument(
+        "--pin_cpus",
+        action="store_true",
+        help="将并行的样本任务各自绑定到同一 NUMA 节点上的一组 CPU（仅 Linux，--parallel_jobs 大于 1 时生效）。"
+    )
+    parser.add_argument(
+        "--otu_mapping",
+        choices=["uc", "usearch_global"],
+        default="uc",
+        help="OTU 表的生成方式：uc（默认）按聚类结果统计，所属聚类为嵌合体的 reads 不计入；"
+             "usearch_global 将去重复序列以 97%% 相似度比对到非嵌合 OTU（与早期版本相同，但需要再次比对）。"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="重新执行所有步骤。默认跳过输出文件已存在、比输入文件新且参数未改变的步骤。"
+    )
+    # 以下参数对应运行中的交互提示；省略时仍在运行中提示输入
+    group = parser.add_argument_group("流程参数", "省略时在运行中交互提示；全部给出即可无人值守运行。")
+    group.add_argument(
+        "--marker_mode",
+        choices=["range", "fixed"],
+        help="PCR 产物长度类型：range 为一定范围内，fixed 为固定的一个/多个值。"
+    )
+    group.add_argument(
+        "--min_length",
+        type=positive_int,
+        help="目标 reads 的最小长度（--marker_mode range）。"
+    )
+    group.add_argument(
+        "--max_length",
+        type=positive_int,
+        help="目标 reads 的最大长度（--marker_mode range）。"
+    )
+    group.add_argument(
+        "--fixed_lengths",
+        type=positive_int,
+        nargs="+",
+        metavar="N",
+        help="目标标记的一个或多个长度值（--marker_mode fixed）。"
+    )
+    group.add_argument(
+        "--cluster_method",
+        choices=["uparse3", "unoise3"],
+        help="聚类策略：uparse3（OTU）或 unoise3（ASV）。"
+    )
+    group.add_argument(
+        "--chimera_method",
+        choices=["denovo", "ref"],
+        help="嵌合体检测方法：denovo 或 ref（参考数据库）。"
+    )
+    group.add_argument(
+        "--chimera_ref",
+        help="嵌合体检测参考数据库路径（--chimera_method ref）。"
+    )
+    sintax = group.add_mutually_exclusive_group()
+    sintax.add_argument(
+        "--sintax",
+        dest="sintax",
+        action="store_const",
+        const=True,
+        help="执行 SINTAX 分类注释。"
+    )
+    sintax.add_argument(
+        "--no_sintax",
+        dest="sintax",
+        action="store_const",
+        const=False,
+        help="不执行 SINTAX 分类注释。"
+    )
+    group.add_argument(
+        "--sintax_db",
+        help="SINTAX 分类参考数据库路径（隐含 --sintax）。"
+    )
+    args = parser.parse_args()
+
+    # 由具体参数推断未指定的类型，并检查参数之间是否冲突
+    if args.marker_mode is None:
+        if args.fixed_lengths:
+            args.marker_mode = "fixed"
+        elif args.min_length is not None or args.max_length is not None:
+            args.marker_mode = "range"
+    if args.marker_mode == "range" and args.fixed_lengths:
+        parser.error("--fixed_lengths 只能与 --marker_mode fixed 一起使用。")
+    if args.marker_mode == "fixed" and (args.min_length is not None or args.max_length is not None):
+        parser.error("--min_length/--max_length 只能与 --marker_mode range 一起使用。")
+    if args.min_length is not None and args.max_length is not None and args.max_length < args.min_length:
+        parser.error("--max_length 必须大于或等于 --min_length。")
+    if args.chimera_ref:
+        if args.chimera_method == "denovo":
+            parser.error("--chimera_ref 只能与 --chimera_method ref 一起使用。")
+        args.chimera_method = "ref"
+    if args.sintax_db:
+        if args.sintax is False:
+            parser.error("--sintax_db 不能与 --no_sintax 一起使用。")
+        args.sintax = True
+    for path in (args.chimera_ref, args.sintax_db):
+        if path and not os.path.exists(path):
+            parser.error(f"文件 {path} 不存在。")
+    return args
 
 def main():
     # 解析命令行参数
@@ -132,6 +1051,16 @@ def main():
     metadata_file = os.path.abspath(args.metadata_file)
     output_dir = os.path.abspath(args.output_dir)
     threads = args.threads
+    parallel_jobs = args.parallel_jobs
+    # 每个样本任务分得的线程数
+    threads_per_job = max(1, threads // parallel_jobs)
+    gzip_intermediates = args.gzip_intermediates
+    suffix = ".gz" if gzip_intermediates else ""
+    force = args.force
+    pin_cpus = args.pin_cpus
+    if pin_cpus and not hasattr(os, "sched_setaffinity"):
+        logging.warning("当前系统不支持 CPU 绑定，忽略 --pin_cpus。")
+        pin_cpus = False
 
     # 检查输入文件和目录是否存在
     if not os.path.exists(input_dir):
@@ -139,111 +1068,127 @@ def main():
     if not os.path.exists(metadata_file):
         raise FileNotFoundError(f"元数据文件 {metadata_file} 不存在。")
     os.makedirs(output_dir, exist_ok=True)
+    # 各外部工具的输出写入 logs 目录
+    log_dir = os.path.join(output_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
 
-    # 检查所需工具
-    tools = {
-        "cutadapt": check_tool("cutadapt"),
-        "vsearch": check_tool("vsearch"),
-        "usearch": check_tool("usearch"),
-        "seqkit": check_tool("seqkit"),
-        "csvtk": check_tool("csvtk")
-    }
+    # 检查所需工具：先并发查找各工具路径，再依次确认（未找到的工具逐个提示输入）
+    # --gzip_intermediates 时用 pigz 压缩去重复结果（cutadapt -Z 输出 .gz 时不依赖 pigz）
+    tool_names = ["cutadapt", "vsearch", "usearch", "seqkit", "csvtk"]
+    if gzip_intermediates:
+        tool_names.append("pigz")
+    with ThreadPoolExecutor(max_workers=len(tool_names)) as executor:
+        list(executor.map(find_tool, tool_names))
+    tools = {tool_name: check_tool(tool_name) for tool_name in tool_names}
 
     # 读取元数据，假设文件无表头，列顺序为：
     # run_id, sample_id, forward_primer, reverse_primer, forward_file, reverse_file
     logging.info("正在加载元数据...")
-    metadata = pd.read_csv(metadata_file, sep='\t', header=None)
-    metadata.columns = ['run_id', 'sample_id', 'forward_primer', 'reverse_primer', 'forward_file', 'reverse_file']
+    rows = load_metadata(metadata_file)
+    sample_ids = [row.sample_id for row in rows]
 
     # Step 1: 样本解复用（双端模式）
-    # 使用 cutadapt 同时处理正向和反向原始数据
+    # 共享同一对原始文件的样本由一次 cutadapt 调用完成解复用；
+    # 引物有重复、无法一一配对的样本仍逐个样本解复用
     demultiplex_dir = os.path.join(output_dir, "1-demultiplex")
     os.makedirs(demultiplex_dir, exist_ok=True)
-    for _, row in metadata.iterrows():
-        sample_id = row['sample_id']
-        barcode_for = row['forward_primer']
-        barcode_rev = row['reverse_primer']
-        forward_file = os.path.join(input_dir, row['forward_file'])
-        reverse_file = os.path.join(input_dir, row['reverse_file'])
-        output_forward = os.path.join(demultiplex_dir, f"{sample_id}.R1.fastq")
-        output_reverse = os.path.join(demultiplex_dir, f"{sample_id}.R2.fastq")
-        
-        if not os.path.exists(forward_file) or not os.path.exists(reverse_file):
-            logging.warning(f"跳过 {sample_id} - 正向或反向文件未找到。")
+    available = scan_dir(input_dir)
+    groups = {}
+    for row in rows:
+        if not (file_in(input_dir, row.forward_file, available)
+                and file_in(input_dir, row.reverse_file, available)):
+            logging.warning("跳过 %s - 正向或反向文件未找到。", row.sample_id)
             continue
-        
-        cmd = [
-            tools["cutadapt"],
-            "-g", f"^{barcode_for}",
-            "-G", f"^{barcode_rev}",
-            "-o", output_forward,
-            "-p", output_reverse,
-            "-j", str(threads),
-            "--discard-untrimmed",
-            "-e", "0.1",
-            forward_file, reverse_file
-        ]
-        run_command(cmd, f"样本解复用 {sample_id}")
-
-    # Step 2: 合并双端测序文件（对解复用后的数据进行合并）
-    merge_dir = os.path.join(output_dir, "2-merge")
-    os.makedirs(merge_dir, exist_ok=True)
-    for _, row in metadata.iterrows():
-        sample_id = row['sample_id']
-        demux_forward = os.path.join(demultiplex_dir, f"{sample_id}.R1.fastq")
-        demux_reverse = os.path.join(demultiplex_dir, f"{sample_id}.R2.fastq")
-        merge_out = os.path.join(merge_dir, f"{sample_id}.merged.fastq")
-        
-        if not os.path.exists(demux_forward) or not os.path.exists(demux_reverse):
-            logging.warning(f"跳过 {sample_id} - 解复用文件未找到。")
-            continue
-        
-        cmd = [
-            tools["vsearch"], "--fastq_mergepairs", demux_forward,
-            "--reverse", demux_reverse,
-            "--threads", str(threads),
-            "--fastqout", merge_out,
-            "--fastq_eeout"
-        ]
-        run_command(cmd, f"合并样本 {sample_id} 的双端测序文件")
-
-    # Step 3: 质量过滤
-    quality_dir = os.path.join(output_dir, "3-quality")
-    os.makedirs(quality_dir, exist_ok=True)
-    marker_type = get_valid_input(
-        "PCR 产物长度类型: 1. 在一定范围内(default 200~400bp); 2. 固定为一个/多个值: ",
-        validator=lambda x: x in ["1", "2"],
-        error_msg="请输入 1 或 2。"
-    )
-    if marker_type == "1":
-        min_length = get_valid_input(
-            "请输入目标 reads 的最小长度: ",
-            validator=lambda x: x.isdigit() and int(x) > 0,
-            error_msg="请输入正整数。"
-        )
-        max_length = get_valid_input(
-            "请输入目标 reads 的最大长度: ",
-            validator=lambda x: x.isdigit() and int(x) >= int(min_length),
-            error_msg="请输入大于或等于最小长度的正整数。"
-        )
-        for sample_id in metadata['sample_id']:
-            input_file = os.path.join(merge_dir, f"{sample_id}.merged.fastq")
-            output_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
-            if not os.path.exists(input_file):
-                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
+        groups.setdefault((row.forward_file, row.reverse_file), []).append(row)
+    # 指定 --chunk_size 时，大于该大小的原始文件先拆分为多份，各分块作为独立的文件对并行解复用，
+    # 分块中的样本以临时ID（样本ID.part_NNN）输出，完成后按样本合并
+    chunked = {}
+    if args.chunk_size:
+        chunk_bytes = args.chunk_size * 1024 ** 3
+        for (forward_name, reverse_name), group in list(groups.items()):
+            forward_file = os.path.join(input_dir, forward_name)
+            reverse_file = os.path.join(input_dir, reverse_name)
+            size = os.path.getsize(forward_file)
+            if size <= chunk_bytes:
                 continue
-            cmd = [
-                tools["vsearch"], "--fastx_filter", input_file,
-                "--fastaout", output_file,
-                "--fastq_maxee", "1.0",
-                "--fastq_maxee_rate", "0.01",
-                "--fastq_minlen", min_length,
-                "--fastq_maxlen", max_length,
-                "--fastq_maxns", "0",
-                "--fasta_width", "0",
-                "--threads", str(threads)
-            ]
-            run_command(cmd, f"质量过滤 {sample_id}")
+            outputs = [os.path.join(demultiplex_dir, f"{row.sample_id}.{read}.fastq.gz")
+                       for row in group for read in ("R1", "R2")]
+            if not force and up_to_date(outputs, [forward_file, reverse_file]):
+                logging.info("跳过 %s - 解复用结果已是最新。", forward_name)
+                del groups[(forward_name, reverse_name)]
+                continue
+            parts = max(2, math.ceil(size / chunk_bytes))
+            # 不同子目录中的原始文件可能同名（如 runA/r1.fq.gz 与 runB/r1.fq.gz），
+            # 目录名附加正反向文件相对路径的哈希，保证每对文件的分块互不覆盖
+            pair_hash = hashlib.sha1(f"{forward_name}\t{reverse_name}".encode()).hexdigest()[:10]
+            chunk_dir = os.path.join(output_dir, "0-chunks", f"{os.path.basename(forward_name)}.{pair_hash}")
+            chunk_pairs = split_pair(tools, forward_file, reverse_file, parts, chunk_dir,
+                                     threads, log_dir, force=force)
+            del groups[(forward_name, reverse_name)]
+            for index, chunk_pair in enumerate(chunk_pairs, 1):
+                part_rows = []
+                for row in group:
+                    part_id = f"{row.sample_id}.part_{index:03d}"
+                    chunked.setdefault(row.sample_id, []).append(part_id)
+                    # 分块路径为绝对路径，os.path.join(input_dir, ...) 时保持不变
+                    part_rows.append(row._replace(sample_id=part_id, forward_file=chunk_pair[0],
+                                                  reverse_file=chunk_pair[1]))
+                groups[chunk_pair] = part_rows
+    batches, singles = [], []
+    for group in groups.values():
+        forward_primers = {row.forward_primer.upper() for row in group}
+        reverse_primers = {row.reverse_primer.upper() for row in group}
+        if len(group) > 1 and len(forward_primers) == len(reverse_primers) == len(group):
+            batches.append(group)
+        else:
+            if len(group) > 1:
+                logging.warning("%s 中的样本引物有重复，逐个样本解复用。", group[0].forward_file)
+            singles.extend(group)
+    if batches:
+        batch_threads = max(1, threads // min(parallel_jobs, len(batches)))
+        run_samples(demux_group, batches, parallel_jobs,
+                    tools, input_dir, demultiplex_dir, batch_threads, log_dir,
+                    pin_cpus=batch_threads if pin_cpus else 0, force=force)
+    if singles:
+        run_samples(demux_one, singles, parallel_jobs,
+                    tools, input_dir, demultiplex_dir, threads_per_job, log_dir,
+                    pin_cpus=threads_per_job if pin_cpus else 0, force=force)
+    for sample_id, part_ids in chunked.items():
+        merge_chunk_outputs(sample_id, part_ids, demultiplex_dir)
+    if chunked:
+        shutil.rmtree(os.path.join(output_dir, "0-chunks"), ignore_errors=True)
+
+    # Step 2-4: 合并双端测序文件、质量过滤、去重复
+    # 每个样本的三个步骤串联执行：合并结果经命名管道传给质量过滤，过滤结果经标准输出管道传给去重复，仅在磁盘上保留去重复结果
+    # 先获取质量过滤所需的长度参数（命令行未指定时交互提示）
+    marker_type = {"range": "1", "fixed": "2"}.get(args.marker_mode)
+    if marker_type is None:
+        marker_type = get_valid_input(
+            "PCR 产物长度类型: 1. 在一定范围内(default 200~400bp); 2. 固定为一个/多个值: ",
+            validator=lambda x: x in ["1", "2"],
+            error_msg="请输入 1 或 2。"
+        )
+    if marker_type == "1":
+        if args.min_length is not None:
+            min_length = str(args.min_length)
+        else:
+            min_length = get_valid_input(
+                "请输入目标 reads 的最小长度: ",
+                validator=lambda x: x.isdigit() and int(x) > 0
+                and (args.max_length is None or int(x) <= args.max_length),
+                error_msg="请输入不大于最大长度的正整数。"
+            )
+        if args.max_length is not None:
+            max_length = str(args.max_length)
+        else:
+            max_length = get_valid_input(
+                "请输入目标 reads 的最大长度: ",
+                validator=lambda x: x.isdigit() and int(x) >= int(min_length),
+                error_msg="请输入大于或等于最小长度的正整数。"
+            )
+        length_kwargs = {"min_length": min_length, "max_length": max_length}
+    elif args.fixed_lengths:
+        length_kwargs = {"lengths": [str(length) for length in args.fixed_lengths]}
     else:
         def validate_lengths(s):
             tokens = s.split()
@@ -254,98 +1199,109 @@ def main():
             validator=validate_lengths,
             error_msg="请输入一个或多个正整数，用空格分隔。"
         )
-        lengths = lengths_input.split()
-        for sample_id in metadata['sample_id']:
-            input_file = os.path.join(merge_dir, f"{sample_id}.merged.fastq")
-            temp_file = os.path.join(quality_dir, f"{sample_id}.temp.fastq")
-            output_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
-            if not os.path.exists(input_file):
-                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
-                continue
-            with open(temp_file, 'w') as temp_f:
-                for length in lengths:
-                    cmd = [
-                        tools["seqkit"], "seq", "-j", str(threads),
-                        "-m", length, "-M", length, input_file
-                    ]
-                    subprocess.run(cmd, stdout=temp_f, check=True)
-            cmd = [
-                tools["vsearch"], "--fastx_filter", temp_file,
-                "--fastaout", output_file,
-                "--fastq_maxee", "1.0",
-                "--fastq_maxee_rate", "0.01",
-                "--fastq_maxns", "0",
-                "--fasta_width", "0",
-                "--threads", str(threads)
-            ]
-            run_command(cmd, f"质量过滤 {sample_id}")
-            os.remove(temp_file)
+        length_kwargs = {"lengths": lengths_input.split()}
 
-    # Step 4: 去重复
     dereplicate_dir = os.path.join(output_dir, "4-dereplicate")
     os.makedirs(dereplicate_dir, exist_ok=True)
-    all_derep_file = os.path.join(dereplicate_dir, "all_samples_derep.fasta")
-    with open(all_derep_file, 'w') as all_f:
-        for sample_id in metadata['sample_id']:
-            input_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
-            output_file = os.path.join(dereplicate_dir, f"{sample_id}.derep.fasta")
-            if not os.path.exists(input_file):
-                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
-                continue
-            cmd = [
-                tools["vsearch"], "--derep_fulllength", input_file,
-                "--strand", "plus",
-                "--output", output_file,
-                "--sizeout",
-                "--relabel", f"{sample_id}.",
-                "--fasta_width", "0",
-                "--threads", str(threads)
-            ]
-            run_command(cmd, f"样本内去重复 {sample_id}")
-            with open(output_file, 'r') as f:
-                all_f.write(f.read())
+    all_derep_file = os.path.join(dereplicate_dir, f"all_samples_derep.fasta{suffix}")
+    available = scan_dir(demultiplex_dir)
+    demuxed = []
+    for sample_id in sample_ids:
+        if f"{sample_id}.R1.fastq.gz" in available and f"{sample_id}.R2.fastq.gz" in available:
+            demuxed.append(sample_id)
+        else:
+            logging.warning("跳过 %s - 解复用文件未找到。", sample_id)
+    derep_done = run_samples(merge_filter_derep_one, demuxed, parallel_jobs,
+                             tools, demultiplex_dir, dereplicate_dir, threads_per_job, log_dir,
+                             pin_cpus=threads_per_job if pin_cpus else 0,
+                             gzip_output=gzip_intermediates, force=force, **length_kwargs)
+    # 按元数据顺序合并各样本的去重复结果，以 sendfile（或二进制分块）拷贝，避免将整个文件读入内存
+    # （多个 gzip 文件直接拼接仍是合法的 gzip 文件）
+    derep_samples = [sample_id for sample_id in sample_ids if sample_id in derep_done]
+    derep_files = [os.path.join(dereplicate_dir, f"{sample_id}.derep.fasta{suffix}")
+                   for sample_id in derep_samples]
+    # 参与合并的样本改变时（例如新增或缺少某个样本）也需要重新合并
+    merge_params = {"samples": derep_samples}
+    if force or not up_to_date([all_derep_file], derep_files, merge_params):
+        remove_outputs([params_file([all_derep_file])])
+        # 先写入临时文件再重命名，中断时不会留下残缺的合并文件
+        temp_derep_file = all_derep_file + ".tmp"
+        with open(temp_derep_file, 'wb', buffering=1 << 20) as all_f:
+            for output_file in derep_files:
+                append_file(output_file, all_f)
+        os.replace(temp_derep_file, all_derep_file)
+        write_params([all_derep_file], merge_params)
+    # 合并文件中同一序列在多个样本中重复出现，聚类前再做一次全局去重复。
+    # --derep_smallmem 按输入顺序流式处理、内存占用低；以序列 SHA1 作为标签，跨运行保持稳定。
+    # 带样本前缀的合并文件仍保留，用于 Step 7 按样本统计丰度
+    uniques_file = os.path.join(dereplicate_dir, "all_samples_uniques.fasta")
+    cmd = [
+        tools["vsearch"], "--derep_smallmem", all_derep_file,
+        "--fastaout", uniques_file,
+        "--sizein", "--sizeout",
+        "--relabel_sha1",
+        "--fasta_width", "0",
+        "--threads", str(threads)
+    ]
+    run_command(cmd, "全局去重复",
+                os.path.join(log_dir, "4-derep_global.log"),
+                inputs=[all_derep_file], outputs=[uniques_file], force=force)
 
     # Step 5: 聚类
     cluster_dir = os.path.join(output_dir, "5-cluster")
     os.makedirs(cluster_dir, exist_ok=True)
-    cluster_method = get_valid_input(
-        "请输入聚类策略: 1. UPARSE3; 2. UNOISE3: ",
-        validator=lambda x: x in ["1", "2"],
-        error_msg="请输入 1 或 2。"
-    )
+    cluster_method = {"uparse3": "1", "unoise3": "2"}.get(args.cluster_method)
+    if cluster_method is None:
+        cluster_method = get_valid_input(
+            "请输入聚类策略: 1. UPARSE3; 2. UNOISE3: ",
+            validator=lambda x: x in ["1", "2"],
+            error_msg="请输入 1 或 2。"
+        )
     otu_file = os.path.join(cluster_dir, "otus.fasta")
+    # 记录每条序列所属的中心序列，Step 7 据此生成 OTU 表
+    uc_file = os.path.join(cluster_dir, "clusters.uc")
     if cluster_method == "1":
         cmd = [
-            tools["vsearch"], "--cluster_smallmem", all_derep_file,
+            tools["vsearch"], "--cluster_smallmem", uniques_file,
             "--id", "0.97",
             "--usersort",
             "--centroids", otu_file,
+            "--uc", uc_file,
             "--strand", "plus",
             "--sizein", "--sizeout",
             "--fasta_width", "0",
             "--threads", str(threads)
         ]
-        run_command(cmd, "使用 UPARSE3 进行 OTU 聚类")
+        run_command(cmd, "使用 UPARSE3 进行 OTU 聚类",
+                    os.path.join(log_dir, "5-cluster.log"),
+                    inputs=[uniques_file], outputs=[otu_file, uc_file], force=force,
+                    params={"cluster_method": cluster_method})
     else:
         cmd = [
-            tools["vsearch"], "--unoise3", all_derep_file,
+            tools["vsearch"], "--unoise3", uniques_file,
             "--centroids", otu_file,
+            "--uc", uc_file,
             "--usersort",
             "--sizein", "--sizeout",
             "--fasta_width", "0",
             "--threads", str(threads)
         ]
-        run_command(cmd, "使用 UNOISE3 进行 ASV 聚类")
+        run_command(cmd, "使用 UNOISE3 进行 ASV 聚类",
+                    os.path.join(log_dir, "5-cluster.log"),
+                    inputs=[uniques_file], outputs=[otu_file, uc_file], force=force,
+                    params={"cluster_method": cluster_method})
 
     # Step 6: 嵌合体检测
     chimera_dir = os.path.join(output_dir, "6-chimera")
     os.makedirs(chimera_dir, exist_ok=True)
     nochim_file = os.path.join(chimera_dir, "otus_nochim.fasta")
-    chimera_method = get_valid_input(
-        "嵌合体检测方法: 1. de novo; 2. 参考数据库: ",
-        validator=lambda x: x in ["1", "2"],
-        error_msg="请输入 1 或 2。"
-    )
+    chimera_method = {"denovo": "1", "ref": "2"}.get(args.chimera_method)
+    if chimera_method is None:
+        chimera_method = get_valid_input(
+            "嵌合体检测方法: 1. de novo; 2. 参考数据库: ",
+            validator=lambda x: x in ["1", "2"],
+            error_msg="请输入 1 或 2。"
+        )
     if chimera_method == "1":
         cmd = [
             tools["vsearch"], "--uchime_denovo", otu_file,
@@ -356,9 +1312,12 @@ def main():
             "--fasta_width", "0",
             "--threads", str(threads)
         ]
-        run_command(cmd, "执行 de novo 嵌合体检测")
+        run_command(cmd, "执行 de novo 嵌合体检测",
+                    os.path.join(log_dir, "6-chimera.log"),
+                    inputs=[otu_file], outputs=[nochim_file], force=force,
+                    params={"chimera_method": chimera_method})
     else:
-        ref_db = get_valid_input(
+        ref_db = args.chimera_ref or get_valid_input(
             "请输入参考数据库路径: ",
             validator=lambda x: os.path.exists(x),
             error_msg="文件不存在，请输入正确的路径。"
@@ -372,35 +1331,54 @@ def main():
             "--fasta_width", "0",
             "--threads", str(threads)
         ]
-        run_command(cmd, "执行参考数据库嵌合体检测")
+        run_command(cmd, "执行参考数据库嵌合体检测",
+                    os.path.join(log_dir, "6-chimera.log"),
+                    inputs=[otu_file, ref_db], outputs=[nochim_file], force=force,
+                    params={"chimera_method": chimera_method, "chimera_ref": os.path.abspath(ref_db)})
 
     # Step 7: OTU 表生成
     otu_dir = os.path.join(output_dir, "7-OTU")
     os.makedirs(otu_dir, exist_ok=True)
     otu_table = os.path.join(otu_dir, "otu_table.txt")
-    cmd = [
-        tools["vsearch"], "--usearch_global", all_derep_file,
-        "--db", nochim_file,
-        "--usersort",
-        "--id", "0.97",
-        "--otutabout", otu_table,
-        "--strand", "plus",
-        "--sizein",
-        "--threads", str(threads)
-    ]
-    run_command(cmd, "生成 OTU 表")
+    table_params = {"samples": derep_samples, "otu_mapping": args.otu_mapping}
+    if args.otu_mapping == "usearch_global":
+        # 将各样本的去重复序列以 97% 相似度比对到非嵌合 OTU，所有能比对上的 reads 均计入
+        cmd = [
+            tools["vsearch"], "--usearch_global", all_derep_file,
+            "--db", nochim_file,
+            "--usersort",
+            "--id", "0.97",
+            "--otutabout", otu_table,
+            "--strand", "plus",
+            "--sizein",
+            "--threads", str(threads)
+        ]
+        run_command(cmd, "生成 OTU 表",
+                    os.path.join(log_dir, "7-otutab.log"),
+                    inputs=[all_derep_file, nochim_file], outputs=[otu_table], force=force,
+                    params=table_params)
+    # 默认直接使用聚类时得到的序列归属，按样本累加丰度并去掉嵌合体 OTU，不再将去重复序列重新比对到 OTU
+    elif force or not up_to_date([otu_table], [all_derep_file, uc_file, nochim_file], table_params):
+        logging.info("Running: 生成 OTU 表")
+        remove_outputs([params_file([otu_table])])
+        build_otu_table(all_derep_file, uc_file, nochim_file, otu_table, derep_samples)
+        write_params([otu_table], table_params)
+    else:
+        logging.info("跳过 生成 OTU 表 - 输出已是最新。")
 
     # Step 8: 分类（可选）
-    classify = get_valid_input(
-        "是否执行 SINTAX 分类注释？(yes/no): ",
-        validator=lambda x: x.lower() in ["yes", "no"],
-        error_msg="请输入 yes 或 no。"
-    )
+    classify = {True: "yes", False: "no"}.get(args.sintax)
+    if classify is None:
+        classify = get_valid_input(
+            "是否执行 SINTAX 分类注释？(yes/no): ",
+            validator=lambda x: x.lower() in ["yes", "no"],
+            error_msg="请输入 yes 或 no。"
+        )
     if classify.lower() == "yes":
         sintax_dir = os.path.join(output_dir, "8-SINTAX")
         os.makedirs(sintax_dir, exist_ok=True)
         sintax_out = os.path.join(sintax_dir, "otus_sintax.txt")
-        ref_db = get_valid_input(
+        ref_db = args.sintax_db or get_valid_input(
             "请输入分类参考数据库路径: ",
             validator=lambda x: os.path.exists(x),
             error_msg="文件不存在，请输入正确的路径。"
@@ -414,7 +1392,10 @@ def main():
             "--tabbedout", sintax_out,
             "--threads", str(threads)
         ]
-        run_command(cmd, "执行 SINTAX 分类注释")
+        run_command(cmd, "执行 SINTAX 分类注释",
+                    os.path.join(log_dir, "8-SINTAX.log"),
+                    inputs=[nochim_file, ref_db], outputs=[sintax_out], force=force,
+                    params={"sintax_db": os.path.abspath(ref_db)})
 
     logging.info("扩增子测序数据处理完成！")
     print("处理完成！输出结果位于:", output_dir)
@@ -423,5 +1404,5 @@ if __name__ == "__main__":
     try:
         main()
     except Exception as e:
-        logging.error(f"发生错误: {e}")
+        logging.error("发生错误: %s", e)
         print(f"发生错误: {e}")
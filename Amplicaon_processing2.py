@@ -2,12 +2,17 @@
 # 导入所需模块
 import os                           # 处理文件路径
 import sys                          # 系统相关操作
+import re                           # 正则表达式（检查输入格式）
 import shutil                       # 文件与目录操作
 import subprocess                   # 调用外部命令
+import numpy as np                  # 数值计算
 import pandas as pd                 # 数据处理
 import logging                      # 日志记录
 import argparse                     # 命令行参数解析
-from Bio import SeqIO
+import tempfile                     # 临时目录
+import functools                    # 缓存函数结果
+from collections import deque, namedtuple  # 运行中的进程队列、元数据行
+from concurrent.futures import ProcessPoolExecutor  # 多样本并行处理
 
 # 设置日志记录，日志写入文件 "amplicon_processing.log"，记录级别为 INFO
 logging.basicConfig(
@@ -16,6 +21,13 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"  # 日志格式
 )
 
+# 交互输入的数字格式：非负整数；非负小数（可带指数，如 1e-3）
+INT_RE = re.compile(r"^\d+$")
+FLOAT_RE = re.compile(r"^(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+
+# 元数据文件的一行（无表头 TSV 的列顺序）
+Row = namedtuple('Row', 'run_id sample_id forward_primer reverse_primer forward_file reverse_file')
+
 # 定义一个通用的输入验证函数，循环提示用户输入直到满足要求或输入“exit”退出程序
 def get_valid_input(prompt, validator=None, error_msg="输入不符合要求，请重新输入。"):
     """
@@ -38,10 +50,11 @@ def get_valid_input(prompt, validator=None, error_msg="输入不符合要求，
             print(error_msg)  # 提示错误信息
 
 # 检查指定工具是否在系统路径中可用，如不可用则提示用户输入工具所在目录
+@functools.lru_cache(maxsize=None)
 def check_tool(tool_name):
     """
     检查指定工具是否在系统路径中可用。
-    如果不可用，提示用户输入安装路径。
+    如果不可用，提示用户输入安装路径。结果会被缓存，同一工具只检查一次。
     
     参数:
         tool_name (str): 工具名称
@@ -69,26 +82,30 @@ def check_tool(tool_name):
                 print("Tool not found or not executable. Please try again.")
 
 # 定义运行外部命令的函数，并将命令输出、错误记录到日志中
-def run_command(cmd, description=""):
+def run_command(cmd, description="", capture_stdout=False):
     """
     执行外部命令并检查是否成功。
     
     参数:
         cmd (list): 命令及其参数列表
         description (str): 命令的描述，用于日志记录
+        capture_stdout (bool): 是否捕获标准输出并记录到日志（DEBUG级别）；
+            结果通过参数写入文件的命令不需要，默认丢弃标准输出，避免在内存中缓存大量进度信息
     """
     logging.info(f"Running: {description}")  # 记录描述
     logging.info(f"Command: {' '.join(map(str, cmd))}")  # 记录完整命令
     try:
-        # 调用外部命令，并检查是否执行成功
-        result = subprocess.run(cmd, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        # 调用外部命令，并检查是否执行成功；stderr 仍然捕获，用于记录错误信息
+        stdout = subprocess.PIPE if capture_stdout else subprocess.DEVNULL
+        result = subprocess.run(cmd, check=True, stderr=subprocess.PIPE, stdout=stdout, text=True)
         logging.info(f"{description} completed successfully.")  # 记录成功信息
-        logging.debug(f"Output: {result.stdout}")  # 记录输出（DEBUG级别）
+        if capture_stdout:
+            logging.debug(f"Output: {result.stdout}")  # 记录输出（DEBUG级别）
     except subprocess.CalledProcessError as e:
         logging.error(f"Error in {description}: {e.stderr}")  # 记录错误信息
         raise
 
-# 解析命令行参数，要求输入输入目录、元数据文件、输出目录及线程数
+# 解析命令行参数，要求输入输入目录、元数据文件、输出目录及线程数，可选并行样本数
 def parse_args():
     """
     解析命令行参数。
@@ -136,8 +153,273 @@ def parse_args():
         required=True,
         help="使用的线程/核心数（整数，例如4）。"
     )
+    # 添加并行样本数参数
+    parser.add_argument(
+        "--parallel_jobs",
+        type=int,
+        default=1,
+        help="步骤1-4中同时处理的样本数，每个样本使用 threads // parallel_jobs 个线程（默认1，即逐个样本处理）。"
+    )
     return parser.parse_args()
 
+########################################
+# 步骤 1-4 的单样本处理函数（由进程池并行调用）
+########################################
+def demux_sample(row, tools, input_dir, demultiplex_dir, threads):
+    """
+    使用 cutadapt 对单个样本进行解复用（双端模式）。
+    
+    参数:
+        row (Row): 元数据中该样本的一行
+        tools (dict): 工具路径字典
+        input_dir (str): 原始测序文件目录
+        demultiplex_dir (str): 解复用输出目录
+        threads (int): cutadapt 使用的线程数
+    返回:
+        str: 样本ID，输入文件缺失而跳过时返回 None
+    """
+    sample_id = row.sample_id                         # 获取样本ID
+    barcode_for = row.forward_primer                  # 获取正向引物
+    barcode_rev = row.reverse_primer                  # 获取反向引物
+    forward_file = os.path.join(input_dir, row.forward_file)  # 正向文件完整路径
+    reverse_file = os.path.join(input_dir, row.reverse_file)  # 反向文件完整路径
+    output_forward = os.path.join(demultiplex_dir, f"{sample_id}.R1.fastq")  # 输出正向文件路径
+    output_reverse = os.path.join(demultiplex_dir, f"{sample_id}.R2.fastq")  # 输出反向文件路径
+    
+    # 检查正反向文件是否存在，不存在则跳过该样本
+    if not os.path.exists(forward_file) or not os.path.exists(reverse_file):
+        logging.warning(f"跳过 {sample_id} - 正向或反向文件未找到。")
+        return None
+    
+    # 构造 cutadapt 命令，同时处理正向和反向数据
+    cmd = [
+        tools["cutadapt"],
+        "-g", f"^{barcode_for}",
+        "-G", f"^{barcode_rev}",
+        "-o", output_forward,
+        "-p", output_reverse,
+        "-j", str(threads),
+        "--discard-untrimmed",
+        "-e", "0.1",
+        forward_file, reverse_file
+    ]
+    # 运行 cutadapt 命令进行解复用
+    run_command(cmd, f"样本解复用 {sample_id}")
+    return sample_id
+
+def demux_group(rows, tools, input_dir, demultiplex_dir, threads):
+    """
+    使用 cutadapt 一次性解复用共享同一对原始测序文件的多个样本（双端模式）。
+    各样本的正、反向引物写入锚定的 barcode FASTA 并按顺序配对（--pair-adapters），
+    原始数据只需读取一遍，按 {name} 模板输出每个样本的文件。
+    
+    参数:
+        rows (list): 共享同一对原始文件的元数据行（Row），各样本的正向引物、反向引物均不重复
+        其余参数同 demux_sample
+    返回:
+        tuple: 样本ID元组
+    """
+    forward_file = os.path.join(input_dir, rows[0].forward_file)  # 正向文件完整路径
+    reverse_file = os.path.join(input_dir, rows[0].reverse_file)  # 反向文件完整路径
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 将各样本的引物写入 barcode 文件，序列名即样本ID
+        forward_barcodes = os.path.join(tmp_dir, "forward_barcodes.fasta")
+        reverse_barcodes = os.path.join(tmp_dir, "reverse_barcodes.fasta")
+        with open(forward_barcodes, 'w') as fwd_f, open(reverse_barcodes, 'w') as rev_f:
+            for row in rows:
+                fwd_f.write(f">{row.sample_id}\n^{row.forward_primer}\n")
+                rev_f.write(f">{row.sample_id}\n^{row.reverse_primer}\n")
+        # 构造 cutadapt 命令，{name} 会被替换为匹配到的样本ID
+        cmd = [
+            tools["cutadapt"],
+            "-g", f"file:{forward_barcodes}",
+            "-G", f"file:{reverse_barcodes}",
+            "--pair-adapters",
+            "-o", os.path.join(demultiplex_dir, "{name}.R1.fastq"),
+            "-p", os.path.join(demultiplex_dir, "{name}.R2.fastq"),
+            "-j", str(threads),
+            "--discard-untrimmed",
+            "-e", "0.1",
+            forward_file, reverse_file
+        ]
+        run_command(cmd, f"样本解复用 {os.path.basename(forward_file)}（{len(rows)} 个样本）")
+    return tuple(row.sample_id for row in rows)
+
+def merge_sample(sample_id, tools, demultiplex_dir, merge_dir, threads):
+    """
+    使用 vsearch 合并单个样本解复用后的双端测序文件。
+    
+    返回:
+        str: 样本ID，解复用文件缺失而跳过时返回 None
+    """
+    demux_forward = os.path.join(demultiplex_dir, f"{sample_id}.R1.fastq")  # 解复用正向文件路径
+    demux_reverse = os.path.join(demultiplex_dir, f"{sample_id}.R2.fastq")  # 解复用反向文件路径
+    merge_out = os.path.join(merge_dir, f"{sample_id}.merged.fastq")        # 合并后输出文件路径
+    
+    # 如果解复用文件不存在则跳过该样本
+    if not os.path.exists(demux_forward) or not os.path.exists(demux_reverse):
+        logging.warning(f"跳过 {sample_id} - 解复用文件未找到。")
+        return None
+    
+    # 构造 vsearch 合并命令，将正向和反向文件合并为一个 merged 文件
+    cmd = [
+        tools["vsearch"], "--fastq_mergepairs", demux_forward,
+        "--reverse", demux_reverse,
+        "--threads", str(threads),
+        "--fastqout", merge_out,
+        "--fastq_eeout"
+    ]
+    run_command(cmd, f"合并样本 {sample_id} 的双端测序文件")
+    return sample_id
+
+def filter_sample(sample_id, tools, merge_dir, quality_dir, threads,
+                  min_length=None, max_length=None, length_set=None):
+    """
+    对单个样本的合并结果进行质量过滤。
+    给出 length_set 时只保留长度属于该集合的序列（先用 seqkit 提取），否则按 min_length~max_length 范围过滤。
+    
+    返回:
+        str: 样本ID，输入文件缺失而跳过时返回 None
+    """
+    input_file = os.path.join(merge_dir, f"{sample_id}.merged.fastq")
+    output_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
+    if not os.path.exists(input_file):
+        logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
+        return None
+    if length_set is None:
+        cmd = [
+            tools["vsearch"], "--fastx_filter", input_file,
+            "--fastaout", output_file,
+            "--fastq_maxee", "1.0",
+            "--fastq_maxee_rate", "0.01",
+            "--fastq_minlen", min_length,
+            "--fastq_maxlen", max_length,
+            "--fastq_maxns", "0",
+            "--fasta_width", "0",
+            "--threads", str(threads)
+        ]
+        run_command(cmd, f"质量过滤 {sample_id}")
+        return sample_id
+
+    # 所有长度只需调用一次 seqkit：按最小、最大长度提取；长度不连续时再逐条筛选
+    min_len, max_len = min(length_set), max(length_set)
+    temp_file = os.path.join(quality_dir, f"{sample_id}.temp.fastq")
+    # 提取固定长度序列，写入临时文件
+    cmd = [
+        tools["seqkit"], "seq", "-j", str(threads),
+        "-m", str(min_len), "-M", str(max_len), input_file
+    ]
+    with open(temp_file, 'w') as temp_f:
+        if len(length_set) == max_len - min_len + 1:
+            # 长度连续时范围提取即为所需结果
+            subprocess.run(cmd, stdout=temp_f, check=True)
+        else:
+            # 长度不连续时读取 seqkit 的输出（FASTQ 每条记录 4 行），只保留长度在集合中的 reads
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+            record = []
+            for line in proc.stdout:
+                record.append(line)
+                if len(record) == 4:
+                    if len(record[1].rstrip("\n")) in length_set:
+                        temp_f.writelines(record)
+                    record = []
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+    # 使用 vsearch 对提取后的临时文件进行质量过滤
+    cmd = [
+        tools["vsearch"], "--fastx_filter", temp_file,
+        "--fastaout", output_file,
+        "--fastq_maxee", "1.0",
+        "--fastq_maxee_rate", "0.01",
+        "--fastq_maxns", "0",
+        "--fasta_width", "0",
+        "--threads", str(threads)
+    ]
+    run_command(cmd, f"质量过滤 {sample_id}")
+    os.remove(temp_file)  # 删除临时文件
+    return sample_id
+
+def derep_samples_into(sample_ids, tools, quality_dir, all_f, threads, parallel_jobs):
+    """
+    对每个样本进行样本内去重复，结果按 sample_ids 的顺序经管道直接写入合并文件，不保存各样本的去重复文件。
+    同时运行 parallel_jobs 个 vsearch：按顺序读取最早启动的进程的输出，
+    其余进程在此期间继续计算（输出写满管道时等待读取）。
+    
+    参数:
+        sample_ids (list): 样本ID列表
+        tools (dict): 工具路径字典
+        quality_dir (str): 质量过滤结果目录
+        all_f: 以二进制写模式打开的合并文件
+        threads (int): 每个 vsearch 使用的线程数
+        parallel_jobs (int): 同时运行的 vsearch 数
+    """
+    running = deque()               # 正在运行的 (样本ID, 命令, 进程, 错误输出临时文件)
+    remaining = iter(sample_ids)
+
+    def start_next():
+        # 启动下一个样本的去重复，直到同时运行 parallel_jobs 个或没有剩余样本
+        while len(running) < parallel_jobs:
+            sample_id = next(remaining, None)
+            if sample_id is None:
+                return
+            input_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
+            if not os.path.exists(input_file):
+                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
+                continue
+            cmd = [
+                tools["vsearch"], "--derep_fulllength", input_file,
+                "--strand", "plus",
+                "--output", "-",                # 结果写到标准输出
+                "--sizeout",
+                "--relabel", f"{sample_id}.",
+                "--fasta_width", "0",
+                "--threads", str(threads)
+            ]
+            logging.info(f"Running: 样本内去重复 {sample_id}")
+            logging.info(f"Command: {' '.join(map(str, cmd))}")
+            # 错误输出写入临时文件，避免进度信息写满管道
+            err = tempfile.TemporaryFile()
+            running.append((sample_id, cmd, subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err), err))
+
+    try:
+        start_next()
+        while running:
+            sample_id, cmd, proc, err = running.popleft()
+            # 以 1 MiB 分块拷贝到合并文件，不把整个输出读入内存
+            shutil.copyfileobj(proc.stdout, all_f, length=1 << 20)
+            proc.stdout.close()
+            if proc.wait() != 0:
+                err.seek(0)
+                logging.error(f"Error in 样本内去重复 {sample_id}: {err.read().decode(errors='replace')}")
+                err.close()
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            err.close()
+            logging.info(f"样本内去重复 {sample_id} completed successfully.")
+            start_next()
+    finally:
+        # 出错时终止仍在运行的进程
+        for _, _, proc, err in running:
+            proc.kill()
+            proc.wait()
+            err.close()
+
+def run_samples(worker, items, parallel_jobs, *args, **kwargs):
+    """
+    使用进程池同时处理 parallel_jobs 个样本，按 items 的顺序返回各样本的结果。
+    任一样本出错时抛出该异常。
+    
+    参数:
+        worker (function): 单样本处理函数
+        items (list): 每个样本的输入（元数据行或样本ID）
+        parallel_jobs (int): 同时处理的样本数
+    返回:
+        list: 各样本的 worker 返回值
+    """
+    with ProcessPoolExecutor(max_workers=parallel_jobs) as executor:
+        futures = [executor.submit(worker, item, *args, **kwargs) for item in items]
+        return [future.result() for future in futures]
+
 ########################################
 # 新功能 11：OTU序列重新标记与进一步聚类（可选）
 ########################################
@@ -147,8 +429,11 @@ def relabel_and_cluster(tools, threads, output_dir):
     otu_dir = os.path.join(output_dir, "7-OTU")
     orig_dir = os.getcwd()                      # 保存当前工作目录
     os.chdir(otu_dir)                           # 切换到7-OTU目录
+    # 各步骤输入文件的路径只计算一次
     # 非嵌合体文件路径（6-chimera目录下的 otus_nochim.fasta）
-    nonchim_file = os.path.join(os.path.dirname(otu_dir), "6-chimera", "otus_nochim.fasta")
+    nonchim_file = os.path.join(output_dir, "6-chimera", "otus_nochim.fasta")
+    # 所有去重复序列文件路径（4-dereplicate目录下的 all_samples_derep.fasta）
+    all_derep_file = os.path.join(output_dir, "4-dereplicate", "all_samples_derep.fasta")
     # 定义重命名后临时输出文件名
     temp_otus = "otus.temp.fasta"
     # 构造 vsearch 命令，对非嵌合体序列进行重命名（加上 OTU_ 前缀）
@@ -165,22 +450,19 @@ def relabel_and_cluster(tools, threads, output_dir):
     run_command(cmd_relabel, "OTU重命名")
     
     # 提示用户是否进行第二次 UPARSE3 聚类
-    choice = ""
-    while choice not in ["1", "2"]:
-        choice = input("是否进行第二次UPARSE3聚类？1. Yes; 2. No: ").strip()
+    choice = get_valid_input(
+        "是否进行第二次UPARSE3聚类？1. Yes; 2. No: ",
+        validator=lambda x: x in ["1", "2"],
+        error_msg="请输入 1 或 2。"
+    )
     
     if choice == "1":
-        # 如果选择进行聚类，提示用户输入相似性阈值
-        up_identity = ""
-        while True:
-            up_identity = input("请输入UPARSE3聚类使用的相似性阈值（0~1，如0.97）：").strip()
-            try:
-                val = float(up_identity)
-                if 0 <= val <= 1:
-                    break
-            except:
-                pass
-            print("输入不合法，请重新输入！")
+        # 如果选择进行聚类，提示用户输入相似性阈值（先用正则检查格式，再转换为数字）
+        up_identity = get_valid_input(
+            "请输入UPARSE3聚类使用的相似性阈值（0~1，如0.97）：",
+            validator=lambda x: bool(FLOAT_RE.match(x)) and 0 <= float(x) <= 1,
+            error_msg="输入不合法，请重新输入！"
+        )
         # 定义最终聚类结果文件名
         centroids = "otus.fasta"
         # 构造 vsearch 聚类命令，使用临时重命名文件进行聚类
@@ -196,8 +478,6 @@ def relabel_and_cluster(tools, threads, output_dir):
         ]
         run_command(cmd_cluster, "第二次UPARSE3聚类")
         
-        # 定义所有去重复序列文件路径（4-dereplicate目录下的 all_samples_derep.fasta）
-        all_derep_file = os.path.join(os.path.dirname(otu_dir), "4-dereplicate", "all_samples_derep.fasta")
         # 构造 vsearch 映射命令，将所有去重复序列映射到聚类结果上生成 OTU 表（otutab.txt）
         cmd_map = [
             tools["vsearch"],
@@ -221,7 +501,7 @@ def relabel_and_cluster(tools, threads, output_dir):
         # 如果不进行第二次聚类，则直接映射，构造命令，使用默认相似性阈值 0.97
         cmd_map2 = [
             tools["vsearch"],
-            "--usearch_global", os.path.join(os.path.dirname(otu_dir), "4-dereplicate", "all_samples_derep.fasta"),
+            "--usearch_global", all_derep_file,
             "--db", temp_otus,
             "--id", "0.97",
             "--strand", "plus",
@@ -249,20 +529,23 @@ def plot_rarefaction_curve(tools, threads, output_dir):
     otu_dir = os.path.join(output_dir, "7-OTU")
     orig_dir = os.getcwd()      # 保存当前目录
     os.chdir(otu_dir)           # 切换目录
+    # 元数据和样本ID文件位于输出目录的上一级目录（即 7-OTU 目录的 ../../）
+    parent_dir = os.path.dirname(output_dir)
+    barcode_file = os.path.join(parent_dir, "barcoding_corrected.txt")
+    id_sample_file = os.path.join(parent_dir, "id.sample")
+    # 生成样本ID文件（元数据第二列），注意文件存放位置；直接用 pandas 读取该列，无需调用 shell 和 awk
     try:
-        cmd = "awk '{print $2}' ../../barcoding_corrected.txt > ../../id.sample" # 生成样本ID文件，注意文件存放位置
-        subprocess.run(cmd, shell=True, check=True)
-        pass
-    except:
-        print("Error！barcoding_corrected.txt未找到，或其它原因")
+        barcode_df = pd.read_csv(barcode_file, sep=r"\s+", header=None, usecols=[1], dtype=str)
+        barcode_df[1].to_csv(id_sample_file, index=False, header=False)
+    except FileNotFoundError:
+        print("Error！barcoding_corrected.txt未找到")
     # 构造 usearch 命令，计算稀释曲线，将结果保存到 rare.txt
     cmd_rarefy = [
         "Rarefy_OTUtab.R", "otutab.txt",
-        "../../id.sample"
+        id_sample_file
     ]
     run_command(cmd_rarefy, "计算稀释曲线")
-    # 假定样本ID存放在上一级目录的 id.sample 文件中
-    id_sample_file = os.path.join(os.path.dirname(output_dir), "id.sample")
+    # 读取样本ID（id.sample 文件）
     sample_ids = []
     if os.path.exists(id_sample_file):
         with open(id_sample_file, "r") as f:
@@ -279,33 +562,28 @@ def plot_rarefaction_curve(tools, threads, output_dir):
         print("读取稀释曲线数据失败：", e)
         os.chdir(orig_dir)
         return
-    # 整理数据，每个样本取出 richness 和对应OTU数，并合并为一张表
-    all_data = []
-    for sid in sample_ids:
-        if sid not in rare_df.columns:
-            print(f"警告：样本 {sid} 不在 rare.txt 中！")
-            continue
-        df_sample = rare_df[['richness', sid]].copy()  # 取 richness 和该样本列
-        df_sample.columns = ['X', 'num_otus']          # 重命名列名
-        df_sample['sample'] = sid                      # 添加样本标识
-        all_data.append(df_sample)
-    if not all_data:
+    # 整理数据：只保留 rare.txt 中存在的样本，缺失的样本一次性提示
+    present = [sid for sid in sample_ids if sid in rare_df.columns]
+    missing = [sid for sid in sample_ids if sid not in rare_df.columns]
+    if missing:
+        print(f"警告：样本 {', '.join(missing)} 不在 rare.txt 中！")
+    if not present:
         print("没有找到有效的样本数据，退出绘图。")
         os.chdir(orig_dir)
         return
-    # 合并所有样本数据
-    all_df = pd.concat(all_data, ignore_index=True)
-    # 导入 matplotlib 绘图
+    # rare.txt 本身即为宽表（richness 一列、每个样本一列），直接取出存在的样本列作为绘图数据，无需转为长表
+    wide = rare_df.set_index('richness')[present]
+    # 导入 matplotlib 绘图（只在绘图时导入）；使用非图形界面的 Agg 后端，无显示环境的服务器上也能直接保存 PDF
+    import matplotlib
+    matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    plt.figure(figsize=(8, 6))    # 设置图形尺寸
-    # 按样本分组绘制曲线，每个样本一条曲线，点标记为圆圈
-    for sid, group in all_df.groupby('sample'):
-        plt.plot(group['X'], group['num_otus'], marker='o', label=sid)
-    plt.xlabel("X")               # 设置X轴标签
-    plt.ylabel("num_otus")        # 设置Y轴标签
-    plt.title("Rarefaction curve")  # 设置图形标题
-    plt.legend(title="sample", loc="upper left")  # 添加图例
-    plt.ylim(bottom=0)            # Y轴最小值为0
+    # 一次调用绘制所有样本，每个样本一条曲线，点标记为圆圈
+    ax = wide.plot(marker='o', figsize=(8, 6))
+    ax.set_xlabel("X")               # 设置X轴标签
+    ax.set_ylabel("num_otus")        # 设置Y轴标签
+    ax.set_title("Rarefaction curve")  # 设置图形标题
+    ax.legend(title="sample", loc="upper left")  # 添加图例
+    ax.set_ylim(bottom=0)            # Y轴最小值为0
     plt.tight_layout()            # 自动调整布局
     plt.savefig("rarefaction_curve.pdf")  # 保存图形为 PDF
     plt.close()                   # 关闭绘图
@@ -323,10 +601,9 @@ def filter_low_abundance_otus(tools, threads, output_dir):
     2. 交互提示是否进行低丰度过滤，若选择“否”则直接返回；
     3. 交互获取最低计数阈值（filter_min_count）和最低频率阈值（filter_min_freq）；
     4. 读取 otutab.txt 文件，针对每个样本（列）过滤低丰度数据（count < filter_min_count 或相对频率 < filter_min_freq，则置为0），结果写入 otutab.filter.txt；
-    5. 从过滤后的 OTU 表中提取 OTU ID（第一列，每个 ID 后附加分号），保存到临时文件 list.t1；
-    6. 读取 otus.fasta 文件中的所有序列，筛选序列 ID 中包含 list.t1 中任一OTU ID的序列，保存到 otus.filter.fasta；
-    7. 将未通过过滤的 OTU ID 写入 list.filter，并删除临时文件 list.t1；
-    8. 返回原工作目录。
+    5. 逐条读取 otus.fasta，序列 ID 分号前的部分属于过滤后 OTU 表中 OTU ID 的序列保存到 otus.filter.fasta，
+       其余序列的 ID 同时写入 list.filter；
+    6. 返回原工作目录。
     """
     print("\n========== 13. OTU低丰度数据过滤 ==========")
     # 进入 7-OTU 目录
@@ -335,33 +612,29 @@ def filter_low_abundance_otus(tools, threads, output_dir):
     os.chdir(otu_dir)       # 切换到 7-OTU 目录
 
     # 交互提示是否进行低丰度过滤
-    choice = ""
-    while choice not in ["1", "2"]:
-        choice = input("是否需要过滤低丰度OTU（counts小于阈值设为0）：1. Yes; 2. No: ").strip()
+    choice = get_valid_input(
+        "是否需要过滤低丰度OTU（counts小于阈值设为0）：1. Yes; 2. No: ",
+        validator=lambda x: x in ["1", "2"],
+        error_msg="请输入 1 或 2。"
+    )
     if choice == "2":
         print("不进行低丰度过滤。")
         os.chdir(orig_dir)
         return
 
     # 提示输入最低计数阈值（必须为正整数）
-    filter_min_count = None
-    while True:
-        try:
-            filter_min_count = int(input("请输入最低计数阈值（如50）：").strip())
-            if filter_min_count > 0:
-                break
-        except:
-            pass
-        print("输入不合法，请输入正整数！")
+    filter_min_count = int(get_valid_input(
+        "请输入最低计数阈值（如50）：",
+        validator=lambda x: bool(INT_RE.match(x)) and int(x) > 0,
+        error_msg="输入不合法，请输入正整数！"
+    ))
 
     # 提示输入最低频率阈值（可以是小数）
-    filter_min_freq = None
-    while True:
-        try:
-            filter_min_freq = float(input("请输入最低频率阈值（如0.001）：").strip())
-            break
-        except:
-            print("输入不合法，请输入数字！")
+    filter_min_freq = float(get_valid_input(
+        "请输入最低频率阈值（如0.001）：",
+        validator=lambda x: bool(FLOAT_RE.match(x)),
+        error_msg="输入不合法，请输入数字！"
+    ))
     print(f"过滤参数：最低计数 = {filter_min_count}，最低频率 = {filter_min_freq}")
 
     # -------------------------------
@@ -376,122 +649,53 @@ def filter_low_abundance_otus(tools, threads, output_dir):
         return
 
     # 过滤规则：对每个样本（列），若单个OTU计数小于 filter_min_count 或占该样本总计数的比例小于 filter_min_freq，则将该计数置为0
-    otu_df_filtered = otu_df.copy()
-    for sample in otu_df.columns:
-        total = otu_df[sample].sum()
-        # 过滤：先判断是否满足最低计数和最低频率要求，否则置为0
-        otu_df_filtered[sample] = otu_df[sample].apply(lambda x: x if (x >= filter_min_count and (x / total) >= filter_min_freq) else 0)
+    # 整个矩阵一次性用 NumPy 向量化计算，不再逐列、逐个元素调用 Python 函数
+    mat = otu_df.to_numpy()
+    totals = mat.sum(axis=0).astype(np.float64)  # 每个样本的总计数（按列求和，转为浮点数避免整数除法）
+    # 相对频率：每列除以该列总计数，总计数为0的样本频率记为0
+    freq = np.divide(mat, totals[np.newaxis, :], out=np.zeros(mat.shape), where=totals[np.newaxis, :] > 0)
+    # 过滤：同时满足最低计数和最低频率要求的计数保留，否则置为0
+    mask = (mat >= filter_min_count) & (freq >= filter_min_freq)
+    otu_df_filtered = pd.DataFrame(np.where(mask, mat, 0), index=otu_df.index, columns=otu_df.columns)
 
     # 将过滤后的 OTU 表写入文件 otutab.filter.txt
     otu_df_filtered.to_csv("otutab.filter.txt", sep="\t")
     print("过滤后的 OTU 表已保存到 otutab.filter.txt")
 
     # -------------------------------
-    # Step2. 提取过滤后的 OTU ID 到临时文件 list.t1
-    # -------------------------------
-    otu_ids = []
-    with open("otutab.filter.txt", "r") as f:
-        header = f.readline()  # 跳过表头
-        for line in f:
-            fields = line.strip().split("\t")
-            if fields:
-                # 在OTU ID后加上分号，模仿原函数行为
-                otu_ids.append(fields[0] + ";")
-    with open("list.t1", "w") as f:
-        for otu in otu_ids:
-            f.write(otu + "\n")
-    print("过滤后的 OTU ID 已写入临时文件 list.t1")
-
-    # -------------------------------
-    # Step3. 筛选通过过滤的 OTU序列
+    # Step2. 筛选通过过滤的 OTU序列，同时记录未通过过滤的 OTU ID
     # -------------------------------
-    # 读取 otus.fasta 文件中的所有序列，存入字典
-    all_otus = {}
+    # OTU ID 直接取自内存中过滤后 OTU 表的索引，无需重新读取 otutab.filter.txt，也不再写临时文件 list.t1
+    id_set = set(otu_df_filtered.index.astype(str))
+    # 逐条读取 otus.fasta：序列 ID 中第一个分号之前的部分（如 OTU_1;size=100 中的 OTU_1）在集合中则保留，
+    # 否则记入 list.filter；只需遍历一遍序列，每条序列做一次哈希查找。
+    # SimpleFastaParser 直接返回标题和序列字符串，不构造 SeqRecord 对象；Biopython 只在此处用到，在此导入
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    # 结果先收集在列表中，最后每个文件只调用一次 write
+    passed_records = []
+    failed_ids = []
     try:
-        for record in SeqIO.parse("otus.fasta", "fasta"):
-            all_otus[record.id] = record
+        with open("otus.fasta", "r") as fasta:
+            for title, seq in SimpleFastaParser(fasta):
+                rid = title.partition(" ")[0]  # 序列 ID 为标题中第一个空格之前的部分
+                if rid.split(";", 1)[0] in id_set:
+                    passed_records.append(f">{title}\n{seq}\n")
+                else:
+                    failed_ids.append(rid + "\n")
     except Exception as e:
         print("读取 otus.fasta 失败：", e)
         os.chdir(orig_dir)
         return
-
-    # 筛选通过过滤的 OTU：如果序列 ID 中包含临时文件 list.t1 中任一 OTU ID（含分号）则保留
-    passed_ids = set()
-    for otu in otu_ids:
-        for rid in all_otus:
-            if otu in rid:
-                passed_ids.add(rid)
-
-    # 将通过过滤的 OTU 序列写入 otus.filter.fasta 文件
     with open("otus.filter.fasta", "w") as f:
-        for rid in passed_ids:
-            SeqIO.write(all_otus[rid], f, "fasta")
-    print(f"共有 {len(passed_ids)} 个OTU通过过滤，结果保存在 otus.filter.fasta")
-
-    # -------------------------------
-    # Step4. 记录未通过过滤的 OTU ID
-    # -------------------------------
-    failed_ids = set(all_otus.keys()) - passed_ids
+        f.write("".join(passed_records))
+    print(f"共有 {len(passed_records)} 个OTU通过过滤，结果保存在 otus.filter.fasta")
     with open("list.filter", "w") as f:
-        for rid in failed_ids:
-            f.write(rid + "\n")
+        f.write("".join(failed_ids))
     print("未通过过滤的OTU ID保存在 list.filter")
 
-    # 删除临时文件 list.t1
-    try:
-        os.remove("list.t1")
-    except Exception as e:
-        print("删除临时文件 list.t1 失败：", e)
-
     # 返回原工作目录
     os.chdir(orig_dir)
 
-# 原有 parse_args 函数（与前面定义的 parse_args 相同）
-def parse_args():
-    """
-    解析命令行参数。
-    
-    返回:
-        argparse.Namespace: 解析后的参数对象
-    """
-    parser = argparse.ArgumentParser(
-        description="扩增子测序数据处理脚本",
-        epilog="""
-        该脚本用于处理扩增子测序数据并生成OTU表。处理流程包括：
-        1. 样本解复用（双端模式）
-        2. 合并解复用后的双端测序文件
-        3. 质量过滤
-        4. 去重复
-        5. 聚类
-        6. 嵌合体检测
-        7. OTU表生成
-        8. 可选的SINTAX分类注释
-        使用示例: python script.py -i input_dir -m metadata.tsv -o output_dir -t 4
-        """
-    )
-    parser.add_argument(
-        "-i", "--input_dir",
-        required=True,
-        help="包含所有测序文件的输入目录（绝对或相对路径）。"
-    )
-    parser.add_argument(
-        "-m", "--metadata_file",
-        required=True,
-        help="元数据文件的路径（TSV格式，包含run_id、sample_id、引物和文件信息）。"
-    )
-    parser.add_argument(
-        "-o", "--output_dir",
-        required=True,
-        help="结果输出目录（将自动创建）。"
-    )
-    parser.add_argument(
-        "-t", "--threads",
-        type=int,
-        required=True,
-        help="使用的线程/核心数（整数，例如4）。"
-    )
-    return parser.parse_args()
-
 # 主函数入口
 def main():
     # 解析命令行参数
@@ -500,6 +704,8 @@ def main():
     metadata_file = os.path.abspath(args.metadata_file)   # 获取元数据文件的绝对路径
     output_dir = os.path.abspath(args.output_dir)         # 获取输出目录的绝对路径
     threads = args.threads                                # 获取线程数
+    parallel_jobs = max(1, args.parallel_jobs)            # 步骤1-4中同时处理的样本数
+    threads_per_job = max(1, threads // parallel_jobs)    # 每个样本任务分得的线程数
 
     # 检查输入目录和元数据文件是否存在
     if not os.path.exists(input_dir):
@@ -523,60 +729,44 @@ def main():
     metadata.columns = ['run_id', 'sample_id', 'forward_primer', 'reverse_primer', 'forward_file', 'reverse_file']
 
     # Step 1: 样本解复用（双端模式）——使用 cutadapt 同时处理正向和反向原始数据
+    # 步骤 1-4 中每个样本相互独立，由进程池同时处理 parallel_jobs 个样本
     demultiplex_dir = os.path.join(output_dir, "1-demultiplex")
     os.makedirs(demultiplex_dir, exist_ok=True)           # 创建解复用输出目录
-    for _, row in metadata.iterrows():
-        sample_id = row['sample_id']                      # 获取样本ID
-        barcode_for = row['forward_primer']               # 获取正向引物
-        barcode_rev = row['reverse_primer']               # 获取反向引物
-        forward_file = os.path.join(input_dir, row['forward_file'])  # 正向文件完整路径
-        reverse_file = os.path.join(input_dir, row['reverse_file'])  # 反向文件完整路径
-        output_forward = os.path.join(demultiplex_dir, f"{sample_id}.R1.fastq")  # 输出正向文件路径
-        output_reverse = os.path.join(demultiplex_dir, f"{sample_id}.R2.fastq")  # 输出反向文件路径
-        
+    # itertuples 逐行返回普通元组，不像 iterrows 那样为每一行构造 Series；
+    # 再包装为模块级的命名元组 Row，以便传给进程池中的子进程
+    rows = [Row(*values) for values in metadata.itertuples(index=False, name=None)]
+    # 共享同一对原始文件（通常即同一 run_id）的样本由一次 cutadapt 调用完成解复用，原始数据只读取一遍；
+    # 引物有重复、无法一一对应的样本仍逐个样本解复用
+    groups = {}
+    for row in rows:
+        forward_file = os.path.join(input_dir, row.forward_file)
+        reverse_file = os.path.join(input_dir, row.reverse_file)
         # 检查正反向文件是否存在，不存在则跳过该样本
         if not os.path.exists(forward_file) or not os.path.exists(reverse_file):
-            logging.warning(f"跳过 {sample_id} - 正向或反向文件未找到。")
+            logging.warning(f"跳过 {row.sample_id} - 正向或反向文件未找到。")
             continue
-        
-        # 构造 cutadapt 命令，同时处理正向和反向数据
-        cmd = [
-            tools["cutadapt"],
-            "-g", f"^{barcode_for}",
-            "-G", f"^{barcode_rev}",
-            "-o", output_forward,
-            "-p", output_reverse,
-            "-j", str(threads),
-            "--discard-untrimmed",
-            "-e", "0.1",
-            forward_file, reverse_file
-        ]
-        # 运行 cutadapt 命令进行解复用
-        run_command(cmd, f"样本解复用 {sample_id}")
+        groups.setdefault((row.forward_file, row.reverse_file), []).append(row)
+    batches, singles = [], []
+    for group in groups.values():
+        forward_primers = {row.forward_primer.upper() for row in group}
+        reverse_primers = {row.reverse_primer.upper() for row in group}
+        if len(group) > 1 and len(forward_primers) == len(reverse_primers) == len(group):
+            batches.append(group)
+        else:
+            if len(group) > 1:
+                logging.warning(f"{group[0].forward_file} 中的样本引物有重复，逐个样本解复用。")
+            singles.extend(group)
+    if batches:
+        run_samples(demux_group, batches, parallel_jobs, tools, input_dir, demultiplex_dir,
+                    max(1, threads // min(parallel_jobs, len(batches))))
+    if singles:
+        run_samples(demux_sample, singles, parallel_jobs, tools, input_dir, demultiplex_dir, threads_per_job)
 
     # Step 2: 合并双端测序文件（对解复用后的数据进行合并）
     merge_dir = os.path.join(output_dir, "2-merge")
     os.makedirs(merge_dir, exist_ok=True)                # 创建合并输出目录
-    for _, row in metadata.iterrows():
-        sample_id = row['sample_id']                      # 获取样本ID
-        demux_forward = os.path.join(demultiplex_dir, f"{sample_id}.R1.fastq")  # 解复用正向文件路径
-        demux_reverse = os.path.join(demultiplex_dir, f"{sample_id}.R2.fastq")  # 解复用反向文件路径
-        merge_out = os.path.join(merge_dir, f"{sample_id}.merged.fastq")        # 合并后输出文件路径
-        
-        # 如果解复用文件不存在则跳过该样本
-        if not os.path.exists(demux_forward) or not os.path.exists(demux_reverse):
-            logging.warning(f"跳过 {sample_id} - 解复用文件未找到。")
-            continue
-        
-        # 构造 vsearch 合并命令，将正向和反向文件合并为一个 merged 文件
-        cmd = [
-            tools["vsearch"], "--fastq_mergepairs", demux_forward,
-            "--reverse", demux_reverse,
-            "--threads", str(threads),
-            "--fastqout", merge_out,
-            "--fastq_eeout"
-        ]
-        run_command(cmd, f"合并样本 {sample_id} 的双端测序文件")
+    sample_ids = [row.sample_id for row in rows]
+    run_samples(merge_sample, sample_ids, parallel_jobs, tools, demultiplex_dir, merge_dir, threads_per_job)
 
     # Step 3: 质量过滤
     quality_dir = os.path.join(output_dir, "3-quality")
@@ -599,25 +789,7 @@ def main():
             validator=lambda x: x.isdigit() and int(x) >= int(min_length),
             error_msg="请输入大于或等于最小长度的正整数。"
         )
-        # 对每个样本进行质量过滤
-        for sample_id in metadata['sample_id']:
-            input_file = os.path.join(merge_dir, f"{sample_id}.merged.fastq")
-            output_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
-            if not os.path.exists(input_file):
-                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
-                continue
-            cmd = [
-                tools["vsearch"], "--fastx_filter", input_file,
-                "--fastaout", output_file,
-                "--fastq_maxee", "1.0",
-                "--fastq_maxee_rate", "0.01",
-                "--fastq_minlen", min_length,
-                "--fastq_maxlen", max_length,
-                "--fastq_maxns", "0",
-                "--fasta_width", "0",
-                "--threads", str(threads)
-            ]
-            run_command(cmd, f"质量过滤 {sample_id}")
+        length_kwargs = {"min_length": min_length, "max_length": max_length}
     else:
         # 如果选择固定长度，定义验证函数确保输入为正整数（可多个，用空格分隔）
         def validate_lengths(s):
@@ -629,60 +801,19 @@ def main():
             validator=validate_lengths,
             error_msg="请输入一个或多个正整数，用空格分隔。"
         )
-        lengths = lengths_input.split()
         # 对每个样本先提取固定长度序列，再进行质量过滤
-        for sample_id in metadata['sample_id']:
-            input_file = os.path.join(merge_dir, f"{sample_id}.merged.fastq")
-            temp_file = os.path.join(quality_dir, f"{sample_id}.temp.fastq")
-            output_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
-            if not os.path.exists(input_file):
-                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
-                continue
-            # 对每个固定长度进行提取，写入临时文件
-            with open(temp_file, 'w') as temp_f:
-                for length in lengths:
-                    cmd = [
-                        tools["seqkit"], "seq", "-j", str(threads),
-                        "-m", length, "-M", length, input_file
-                    ]
-                    subprocess.run(cmd, stdout=temp_f, check=True)
-            # 使用 vsearch 对提取后的临时文件进行质量过滤
-            cmd = [
-                tools["vsearch"], "--fastx_filter", temp_file,
-                "--fastaout", output_file,
-                "--fastq_maxee", "1.0",
-                "--fastq_maxee_rate", "0.01",
-                "--fastq_maxns", "0",
-                "--fasta_width", "0",
-                "--threads", str(threads)
-            ]
-            run_command(cmd, f"质量过滤 {sample_id}")
-            os.remove(temp_file)  # 删除临时文件
+        length_kwargs = {"length_set": {int(length) for length in lengths_input.split()}}
+    # 对每个样本进行质量过滤
+    run_samples(filter_sample, sample_ids, parallel_jobs, tools, merge_dir, quality_dir, threads_per_job,
+                **length_kwargs)
 
     # Step 4: 去重复
     dereplicate_dir = os.path.join(output_dir, "4-dereplicate")
     os.makedirs(dereplicate_dir, exist_ok=True)           # 创建去重复输出目录
     all_derep_file = os.path.join(dereplicate_dir, "all_samples_derep.fasta")
-    with open(all_derep_file, 'w') as all_f:
-        # 对每个样本进行去重复处理
-        for sample_id in metadata['sample_id']:
-            input_file = os.path.join(quality_dir, f"{sample_id}.filtered.fasta")
-            output_file = os.path.join(dereplicate_dir, f"{sample_id}.derep.fasta")
-            if not os.path.exists(input_file):
-                logging.warning(f"跳过 {sample_id} - 输入文件 {input_file} 未找到。")
-                continue
-            cmd = [
-                tools["vsearch"], "--derep_fulllength", input_file,
-                "--strand", "plus",
-                "--output", output_file,
-                "--sizeout",
-                "--relabel", f"{sample_id}.",
-                "--fasta_width", "0",
-                "--threads", str(threads)
-            ]
-            run_command(cmd, f"样本内去重复 {sample_id}")
-            with open(output_file, 'r') as f:
-                all_f.write(f.read())
+    # 对每个样本进行去重复处理，结果按元数据顺序经管道直接写入合并文件
+    with open(all_derep_file, 'wb') as all_f:  # 二进制模式写入，拼接时无需编解码
+        derep_samples_into(sample_ids, tools, quality_dir, all_f, threads_per_job, parallel_jobs)
 
     # Step 5: 聚类
     cluster_dir = os.path.join(output_dir, "5-cluster")